@@ -1,10 +1,8 @@
 import streamlit as st
 import os
-from database import DatabaseManager
-from model_handler import ModelHandler
-from rag_system import RAGSystem
-from document_processor import DocumentProcessor
+from concurrent.futures import ThreadPoolExecutor
 import time
+from capabilities import CAPS
 
 # Page configuration
 st.set_page_config(
@@ -13,17 +11,76 @@ st.set_page_config(
     layout="wide"
 )
 
-# Initialize session state
+# Shared resources are created once per process and reused across all sessions.
+# Heavy modules are imported inside the factories so they load on first use only.
+@st.cache_resource
+def get_db():
+    from database import DatabaseManager
+    return DatabaseManager()
+
+@st.cache_resource
+def get_model_handler():
+    from model_handler import ModelHandler
+    return ModelHandler()
+
+@st.cache_resource
+def get_rag(_db):
+    from rag_system import RAGSystem
+    return RAGSystem(_db)
+
+@st.cache_resource
+def get_doc_processor(_db, _rag):
+    from document_processor import DocumentProcessor
+    return DocumentProcessor(_db, _rag)
+
+db_manager = get_db()
+model_handler = get_model_handler()
+rag_system = get_rag(db_manager)
+
+@st.cache_data(ttl=3600)
+def _available_models():
+    return model_handler.get_available_models()
+
+@st.cache_data
+def _model_labels(model_handler_id):
+    available_models = _available_models()
+    return tuple(available_models.keys()), tuple(f"{info['name']} - {info['description']}" for info in available_models.values())
+
+
+@st.cache_resource
+def _bg_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource
+def _conversation_buffer(_db):
+    from database import WriteBehindBuffer
+    return WriteBehindBuffer(_db, max_rows=8, executor=_bg_pool())
+
+def _store_conversation_async(user_message, assistant_response, context_used):
+    """Queue a chat exchange for a batched background write so the UI thread never waits on it."""
+    _conversation_buffer(db_manager).append(user_message, assistant_response, context_used)
+
+# Database reads are memoized per knowledge base version; bump the version after any write
+@st.cache_data(ttl=2)
+def _doc_count(kb_version):
+    return db_manager.get_document_count()
+
+@st.cache_data(ttl=2)
+def _db_stats(kb_version):
+    return db_manager.get_database_stats()
+
+@st.cache_data(ttl=10)
+def _recent_conversations(limit, kb_version):
+    return db_manager.get_recent_conversations(limit)
+
+def _bump_kb_version():
+    st.session_state.kb_version += 1
+
+# Initialize per-session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "db_manager" not in st.session_state:
-    st.session_state.db_manager = DatabaseManager()
-if "model_handler" not in st.session_state:
-    st.session_state.model_handler = ModelHandler()
-if "rag_system" not in st.session_state:
-    st.session_state.rag_system = RAGSystem(st.session_state.db_manager)
-if "doc_processor" not in st.session_state:
-    st.session_state.doc_processor = DocumentProcessor(st.session_state.db_manager)
+if "kb_version" not in st.session_state:
+    st.session_state.kb_version = 0
 
 # Sidebar for document upload and management
 st.sidebar.title("📚 Knowledge Base")
@@ -32,54 +89,44 @@ st.sidebar.title("📚 Knowledge Base")
 st.sidebar.header("Upload Documents")
 
 # Check available file processing capabilities
-try:
-    from document_processor import PDF_AVAILABLE, PANDAS_AVAILABLE, OCR_AVAILABLE, WEB_SCRAPING_AVAILABLE
-    file_types = ["txt"]
-    help_parts = ["text files"]
-    
-    if PDF_AVAILABLE:
-        file_types.extend(["pdf"])
-        help_parts.append("PDF")
-    else:
-        st.sidebar.info("📄 PDF support requires PyPDF2")
-        
-    if PANDAS_AVAILABLE:
-        file_types.extend(["csv"])
-        help_parts.append("CSV")
-    else:
-        st.sidebar.info("📊 CSV support requires pandas")
-        
-    if OCR_AVAILABLE:
-        file_types.extend(["jpg", "jpeg", "png", "gif", "bmp", "tiff"])
-        help_parts.append("images (OCR)")
-    else:
-        st.sidebar.info("🖼️ Image OCR requires tesseract and pytesseract")
-    
-    help_text = f"Upload {', '.join(help_parts)} to add to the knowledge base"
-except:
-    file_types = ["txt"]
-    help_text = "Upload text files to add to the knowledge base"
+if not CAPS.pdf:
+    st.sidebar.info("📄 PDF support requires PyPDF2")
+if not CAPS.pandas:
+    st.sidebar.info("📊 CSV support requires pandas")
+if not CAPS.ocr:
+    st.sidebar.info("🖼️ Image OCR requires tesseract and pytesseract")
 
-uploaded_file = st.sidebar.file_uploader(
+
+uploaded_files = st.sidebar.file_uploader(
     "Choose a document",
-    type=file_types,
-    help=help_text
+    type=list(CAPS.file_types),
+    help=CAPS.help,
+    accept_multiple_files=True
 )
 
-if uploaded_file is not None:
+if uploaded_files:
     # Show file info
-    st.sidebar.write(f"**File:** {uploaded_file.name}")
-    st.sidebar.write(f"**Size:** {uploaded_file.size} bytes")
-    st.sidebar.write(f"**Type:** {uploaded_file.type}")
+    for uploaded_file in uploaded_files:
+        st.sidebar.write(f"**File:** {uploaded_file.name}")
+        st.sidebar.write(f"**Size:** {uploaded_file.size} bytes")
+        st.sidebar.write(f"**Type:** {uploaded_file.type}")
     
     if st.sidebar.button("Process Document"):
         with st.sidebar.spinner("Processing document..."):
             try:
-                success = st.session_state.doc_processor.process_document(uploaded_file)
-                if success:
+                doc_processor = get_doc_processor(db_manager, rag_system)
+                
+                # Images share a single OCR run; other files are processed one by one
+                images = [f for f in uploaded_files if f.name.lower().split('.')[-1] in CAPS.image_types]
+                others = [f for f in uploaded_files if f not in images]
+                results = doc_processor.process_image_batch(images) if images else []
+                results += [doc_processor.process_document(f) for f in others]
+                if any(results):
+                    _bump_kb_version()
+                if all(results):
                     st.sidebar.success("Document processed successfully!")
                     # Show processing details
-                    doc_count = st.session_state.db_manager.get_document_count()
+                    doc_count = _doc_count(st.session_state.kb_version)
                     st.sidebar.info(f"Knowledge base now contains {doc_count} documents")
                 else:
                     st.sidebar.error("Failed to process document. Check the console for details.")
@@ -91,7 +138,7 @@ if uploaded_file is not None:
                 traceback.print_exc()
 
 # Display document count
-doc_count = st.session_state.db_manager.get_document_count()
+doc_count = _doc_count(st.session_state.kb_version)
 st.sidebar.metric("Documents in Knowledge Base", doc_count)
 
 # URL Processing Section
@@ -105,13 +152,14 @@ url_input = st.sidebar.text_input(
 )
 
 if url_input and st.sidebar.button("Process URL"):
-    if WEB_SCRAPING_AVAILABLE:
+    if CAPS.web:
         with st.sidebar.spinner("Fetching and processing URL content..."):
             try:
-                success = st.session_state.doc_processor.process_url(url_input)
+                success = get_doc_processor(db_manager, rag_system).process_url(url_input)
                 if success:
+                    _bump_kb_version()
                     st.sidebar.success("URL content processed successfully!")
-                    doc_count = st.session_state.db_manager.get_document_count()
+                    doc_count = _doc_count(st.session_state.kb_version)
                     st.sidebar.info(f"Knowledge base now contains {doc_count} documents")
                 else:
                     st.sidebar.error("Failed to process URL content. Check the console for details.")
@@ -124,7 +172,8 @@ if url_input and st.sidebar.button("Process URL"):
 # Clear knowledge base button
 if st.sidebar.button("Clear Knowledge Base", type="secondary"):
     if st.sidebar.confirm("Are you sure you want to clear all documents?"):
-        st.session_state.db_manager.clear_documents()
+        db_manager.clear_documents()
+        _bump_kb_version()
         st.sidebar.success("Knowledge base cleared!")
         st.rerun()
 
@@ -132,43 +181,65 @@ if st.sidebar.button("Clear Knowledge Base", type="secondary"):
 st.title("🤖 Ogelo RAG Chat Assistant")
 st.markdown("Chat with an AI assistant that can reference your uploaded documents.")
 
-# Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
-        if "sources" in message and message["sources"]:
-            with st.expander("📖 Sources"):
-                for i, source in enumerate(message["sources"], 1):
-                    st.markdown(f"**Source {i}:** {source}")
-
-# Chat input
-if prompt := st.chat_input("What would you like to know?"):
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+def _format_sources(sources):
+    """Join sources into one markdown block so they render as a single element."""
+    return "\n\n".join(f"**Source {i}:** {source}" for i, source in enumerate(sources, 1))
+
+# Number of most recent messages rendered as full chat bubbles
+MAX_RENDERED_MESSAGES = 50
+
+@st.fragment
+def _render_chat():
+    """Render the chat transcript and handle new input without rerunning the sidebar."""
+    messages = st.session_state.messages
+    
+    # Collapse older turns into a single expander so long sessions stay cheap to redraw
+    older_messages = messages[:-MAX_RENDERED_MESSAGES]
+    if older_messages:
+        with st.expander(f"Older history ({len(older_messages)} messages)"):
+            st.markdown("\n\n".join(f"**{m['role'].title()}:** {m['content']}" for m in older_messages))
+    
+    # Display chat messages
+    for message in messages[-MAX_RENDERED_MESSAGES:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+            if "sources" in message and message["sources"]:
+                with st.expander("📖 Sources"):
+                    st.markdown(_format_sources(message["sources"]))
+
+    # Chat input
+    if prompt := st.chat_input("What would you like to know?"):
+        # Add user message to chat history
+        st.session_state.messages.append({"role": "user", "content": prompt})
     
-    # Display user message
-    with st.chat_message("user"):
-        st.markdown(prompt)
+        # Display user message
+        with st.chat_message("user"):
+            st.markdown(prompt)
     
-    # Generate assistant response
-    with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
+        # Generate assistant response
+        with st.chat_message("assistant"):
+            # One placeholder holds the thinking notice and then the streamed response
+            placeholder = st.empty()
             try:
-                # Get relevant context using RAG
-                context, sources = st.session_state.rag_system.get_relevant_context(prompt)
+                placeholder.markdown("_Thinking..._")
                 
-                # Generate response with context and conversation history
-                response = st.session_state.model_handler.generate_response(
-                    prompt, 
-                    context, 
-                    conversation_history=st.session_state.messages
+                # Get relevant context using RAG, unless the message is small talk
+                context, sources = (
+                    rag_system.get_relevant_context(prompt)
+                    if rag_system.should_retrieve(prompt)
+                    else ("", [])
                 )
                 
-                # Store conversation in database
-                st.session_state.db_manager.store_conversation(prompt, response, context)
-                
-                # Display response
-                st.markdown(response)
+                # Stream the response with context and conversation history as it is generated;
+                # write_stream replaces the thinking notice and returns the full text
+                with placeholder.container():
+                    response = st.write_stream(model_handler.generate_response_stream(
+                        prompt, 
+                        context, 
+                        conversation_history=model_handler.trim_history(st.session_state.messages)
+                    ))
+                if not isinstance(response, str):
+                    response = "".join(str(part) for part in response)
                 
                 # Add assistant message to chat history
                 assistant_message = {
@@ -178,21 +249,27 @@ if prompt := st.chat_input("What would you like to know?"):
                 }
                 st.session_state.messages.append(assistant_message)
                 
+                # Store conversation in database off the render path
+                _store_conversation_async(prompt, response, context)
+                _bump_kb_version()
+                
                 # Display sources if available
                 if sources:
                     with st.expander("📖 Sources"):
-                        for i, source in enumerate(sources, 1):
-                            st.markdown(f"**Source {i}:** {source}")
-                            
+                        st.markdown(_format_sources(sources))
+                        
             except Exception as e:
                 error_msg = f"Sorry, I encountered an error: {str(e)}"
-                st.error(error_msg)
+                placeholder.error(error_msg)
                 st.session_state.messages.append({"role": "assistant", "content": error_msg})
 
-# Clear chat button
-if st.button("Clear Chat History", type="secondary"):
+_render_chat()
+
+# Clear chat button; the callback runs before the rerun, so no second script pass is needed
+def _clear_chat():
     st.session_state.messages = []
-    st.rerun()
+
+st.button("Clear Chat History", type="secondary", on_click=_clear_chat)
 
 # Footer with model info and status
 st.sidebar.markdown("---")
@@ -203,14 +280,13 @@ st.sidebar.markdown("### 🤖 AI Model Selection")
 
 # Get available models
 try:
-    available_models = st.session_state.model_handler.get_available_models()
-    model_options = [f"{info['name']} - {info['description']}" for model_name, info in available_models.items()]
-    model_keys = list(available_models.keys())
+    available_models = _available_models()
+    model_keys, model_options = _model_labels(id(model_handler))
     
     # Find current model index
     current_model_index = 0
     try:
-        current_model_index = model_keys.index(st.session_state.model_handler.model_name)
+        current_model_index = model_keys.index(model_handler.model_name)
     except:
         pass
     
@@ -222,11 +298,22 @@ try:
         help="Select which AI model to use for generating responses"
     )
     
-    # Switch model if changed
+    from model_handler import QUANTIZATION_OPTIONS
+    quant_keys = list(QUANTIZATION_OPTIONS.keys())
+    selected_quant = st.sidebar.selectbox(
+        "Model Precision:",
+        quant_keys,
+        index=quant_keys.index(model_handler.quant) if model_handler.quant in quant_keys else 0,
+        format_func=lambda q: QUANTIZATION_OPTIONS[q],
+        help="INT8/INT4 use bitsandbytes on CUDA GPUs and fall back to unquantized weights elsewhere"
+    )
+    
+    # Switch model if changed; a new model starts at its default precision
     selected_model_key = model_keys[selected_model_index]
-    if selected_model_key != st.session_state.model_handler.model_name:
+    if selected_model_key != model_handler.model_name or selected_quant != model_handler.quant:
+        quant = selected_quant if selected_model_key == model_handler.model_name else None
         with st.sidebar.spinner("Switching model..."):
-            success = st.session_state.model_handler.switch_model(selected_model_key)
+            success = model_handler.switch_model(selected_model_key, quant)
             if success:
                 st.sidebar.success(f"Switched to {available_models[selected_model_key]['name']}")
                 st.rerun()
@@ -241,8 +328,8 @@ try:
     from model_handler import TRANSFORMERS_AVAILABLE
     from rag_system import SENTENCE_TRANSFORMERS_AVAILABLE
     
-    current_model_info = st.session_state.model_handler.get_available_models().get(
-        st.session_state.model_handler.model_name, 
+    current_model_info = _available_models().get(
+        model_handler.model_name, 
         {"name": "Unknown", "description": ""}
     )
     
@@ -260,12 +347,12 @@ except:
     st.sidebar.markdown("🟡 **Model:** Basic mode")
     st.sidebar.markdown("🟡 **Embeddings:** Simple matching")
 
-db_type = st.session_state.db_manager.get_database_type()
+db_type = db_manager.get_database_type()
 st.sidebar.markdown(f"💾 **Database:** {db_type}")
 
 # Check web search status
 try:
-    if st.session_state.model_handler.is_web_search_available():
+    if model_handler.is_web_search_available():
         st.sidebar.markdown("🌐 **Web Search:** Enabled (Perplexity)")
     else:
         st.sidebar.markdown("🟡 **Web Search:** Disabled (API key needed)")
@@ -274,7 +361,7 @@ except:
 
 # Add database statistics
 if st.sidebar.button("📊 Show Database Stats"):
-    stats = st.session_state.db_manager.get_database_stats()
+    stats = _db_stats(st.session_state.kb_version)
     if stats:
         st.sidebar.markdown("### Database Statistics")
         st.sidebar.metric("Documents", stats.get('unique_documents', 0))
@@ -289,19 +376,19 @@ if st.sidebar.button("🔍 Test All Features"):
     with st.sidebar.expander("Test Results", expanded=True):
         # Test database connection
         try:
-            test_count = st.session_state.db_manager.get_document_count()
+            test_count = db_manager.get_document_count()
             st.sidebar.success(f"✅ Database: Connected ({test_count} docs)")
         except Exception as e:
             st.sidebar.error(f"❌ Database: {e}")
         
         # Test model loading and selection
         try:
-            available_models = st.session_state.model_handler.get_available_models()
-            current_model = st.session_state.model_handler.model_name
+            available_models = _available_models()
+            current_model = model_handler.model_name
             model_info = available_models.get(current_model, {})
             st.sidebar.success(f"✅ Model: {model_info.get('name', 'Unknown')} loaded")
             
-            test_response = st.session_state.model_handler.generate_response("Hello")
+            test_response = model_handler.generate_response("Hello")
             if test_response:
                 st.sidebar.success("✅ Response Generation: Working")
             else:
@@ -311,7 +398,7 @@ if st.sidebar.button("🔍 Test All Features"):
         
         # Test embedding system
         try:
-            test_embedding = st.session_state.rag_system.get_embedding("test")
+            test_embedding = rag_system.get_embedding("test")
             if test_embedding is not None and len(test_embedding) > 0:
                 st.sidebar.success("✅ Embeddings: Working")
             else:
@@ -321,20 +408,18 @@ if st.sidebar.button("🔍 Test All Features"):
         
         # Test RAG system with knowledge integration
         try:
-            test_context, test_sources = st.session_state.rag_system.get_relevant_context("machine learning")
+            test_context, test_sources = rag_system.get_relevant_context("machine learning")
             st.sidebar.success(f"✅ RAG System: Working ({len(test_sources)} sources)")
         except Exception as e:
             st.sidebar.error(f"❌ RAG System: {e}")
             
         # Test document processing capabilities
         try:
-            from document_processor import PDF_AVAILABLE, PANDAS_AVAILABLE, OCR_AVAILABLE, WEB_SCRAPING_AVAILABLE
-            
             capabilities = []
-            if PDF_AVAILABLE: capabilities.append("PDF")
-            if PANDAS_AVAILABLE: capabilities.append("CSV") 
-            if OCR_AVAILABLE: capabilities.append("OCR")
-            if WEB_SCRAPING_AVAILABLE: capabilities.append("Web")
+            if CAPS.pdf: capabilities.append("PDF")
+            if CAPS.pandas: capabilities.append("CSV") 
+            if CAPS.ocr: capabilities.append("OCR")
+            if CAPS.web: capabilities.append("Web")
             
             st.sidebar.success(f"✅ Document Processing: {', '.join(capabilities)}")
         except Exception as e:
@@ -342,8 +427,8 @@ if st.sidebar.button("🔍 Test All Features"):
             
         # Test web search integration
         try:
-            if st.session_state.model_handler.is_web_search_available():
-                success, message = st.session_state.model_handler.test_web_search()
+            if model_handler.is_web_search_available():
+                success, message = model_handler.test_web_search()
                 if success:
                     st.sidebar.success("✅ Web Search: Connected")
                 else:
@@ -366,28 +451,27 @@ if st.sidebar.button("🔍 Test All Features"):
 if st.sidebar.button("🔬 Run Full Test Suite"):
     with st.sidebar.spinner("Running comprehensive tests..."):
         try:
-            import subprocess
-            result = subprocess.run(['python', 'comprehensive_test.py'], 
-                                  capture_output=True, text=True, cwd='.')
+            import comprehensive_test
+            ok, test_stdout, test_stderr = comprehensive_test.run(db=db_manager, rag=rag_system, model_handler=model_handler)
             
             with st.sidebar.expander("Full Test Results", expanded=True):
-                if result.returncode == 0:
+                if ok:
                     st.sidebar.success("✅ All tests completed successfully")
                 else:
                     st.sidebar.warning("⚠️ Some tests had issues")
                 
                 # Show test output
-                if result.stdout:
-                    st.sidebar.text_area("Test Output", result.stdout, height=300)
-                if result.stderr:
-                    st.sidebar.text_area("Test Errors", result.stderr, height=150)
+                if test_stdout:
+                    st.sidebar.text_area("Test Output", test_stdout, height=300)
+                if test_stderr:
+                    st.sidebar.text_area("Test Errors", test_stderr, height=150)
                     
         except Exception as e:
             st.sidebar.error(f"❌ Test Suite Error: {e}")
 
 # Add conversation history viewer and integration
 if st.sidebar.button("📜 View Recent Conversations"):
-    recent_conversations = st.session_state.db_manager.get_recent_conversations(5)
+    recent_conversations = _recent_conversations(5, st.session_state.kb_version)
     if recent_conversations:
         with st.sidebar.expander("Recent Conversations", expanded=True):
             for i, (user_msg, assistant_msg) in enumerate(recent_conversations, 1):
@@ -401,16 +485,29 @@ if st.sidebar.button("📜 View Recent Conversations"):
 st.sidebar.markdown("---")
 st.sidebar.markdown("### 💬 Previous Conversations")
 
-if st.sidebar.button("🔄 Load Previous Context"):
-    recent_conversations = st.session_state.db_manager.get_recent_conversations(3)
+def _load_previous_context():
+    """Button callback: prepend recent stored conversations before the script reruns."""
+    recent_conversations = _recent_conversations(3, st.session_state.kb_version)
+    st.session_state.loaded_context_count = len(recent_conversations)
     if recent_conversations:
         # Add recent conversations to current chat session
+        existing = {msg["content"] for msg in st.session_state.messages if msg["role"] == "user"}
+        loaded = []
         for user_msg, assistant_msg in reversed(recent_conversations):
             # Only add if not already in current session
-            if not any(msg["content"] == user_msg for msg in st.session_state.messages if msg["role"] == "user"):
-                st.session_state.messages.insert(0, {"role": "user", "content": user_msg})
-                st.session_state.messages.insert(1, {"role": "assistant", "content": assistant_msg})
-        st.sidebar.success(f"Loaded {len(recent_conversations)} previous conversations")
-        st.rerun()
+            if user_msg not in existing:
+                existing.add(user_msg)
+                loaded.append((user_msg, assistant_msg))
+        # Most recent exchange goes first, matching the previous insert(0, ...) ordering
+        prepend = []
+        for user_msg, assistant_msg in reversed(loaded):
+            prepend.append({"role": "user", "content": user_msg})
+            prepend.append({"role": "assistant", "content": assistant_msg})
+        st.session_state.messages = prepend + st.session_state.messages
+
+if st.sidebar.button("🔄 Load Previous Context", on_click=_load_previous_context):
+    loaded_count = st.session_state.pop("loaded_context_count", 0)
+    if loaded_count:
+        st.sidebar.success(f"Loaded {loaded_count} previous conversations")
     else:
         st.sidebar.info("No previous conversations to load")
@@ -0,0 +1,52 @@
+"""
+Document processing capabilities, detected once when this module is first imported.
+Streamlit reruns app.py on every interaction, but module imports are cached, so the
+optional-dependency probes run only once per process. The probes only locate the
+packages (importlib.util.find_spec) without importing them, so checking what the
+uploader accepts does not load PDF, pandas, OCR or scraping libraries.
+"""
+
+from importlib.util import find_spec
+from types import SimpleNamespace
+
+# Upload extensions routed to OCR
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff')
+
+def _installed(*modules: str) -> bool:
+    """Whether every named top-level module can be imported, without importing it."""
+    return all(find_spec(module) is not None for module in modules)
+
+# Same dependency sets as the optional imports in document_processor
+PDF_AVAILABLE = _installed("PyPDF2")
+PANDAS_AVAILABLE = _installed("pandas")
+OCR_AVAILABLE = _installed("PIL", "pytesseract")
+WEB_SCRAPING_AVAILABLE = _installed("requests", "urllib3", "bs4", "trafilatura")
+
+def _build_caps() -> SimpleNamespace:
+    """Derive uploader file types and help text from the available dependencies."""
+    file_types = ["txt"]
+    help_parts = ["text files"]
+    
+    if PDF_AVAILABLE:
+        file_types.append("pdf")
+        help_parts.append("PDF")
+    
+    if PANDAS_AVAILABLE:
+        file_types.append("csv")
+        help_parts.append("CSV")
+    
+    if OCR_AVAILABLE:
+        file_types.extend(IMAGE_EXTENSIONS)
+        help_parts.append("images (OCR)")
+    
+    return SimpleNamespace(
+        pdf=PDF_AVAILABLE,
+        pandas=PANDAS_AVAILABLE,
+        ocr=OCR_AVAILABLE,
+        web=WEB_SCRAPING_AVAILABLE,
+        image_types=IMAGE_EXTENSIONS if OCR_AVAILABLE else (),
+        file_types=tuple(file_types),
+        help=f"Upload {', '.join(help_parts)} to add to the knowledge base"
+    )
+
+CAPS = _build_caps()
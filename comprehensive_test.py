@@ -9,17 +9,70 @@ import os
 import traceback
 import tempfile
 import io
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
-def test_imports():
+class SuiteRun:
+    """Resources and output streams for one run of the suite.
+    
+    The app passes in its own database, RAG system and model handler so the run
+    reuses the loaded models; anything not passed in is built on first use and
+    dropped with the run. Database writes always go to a scratch database.
+    """
+    
+    def __init__(self, db=None, rag=None, model_handler=None, stdout=None, stderr=None):
+        self._db = db
+        self._rag = rag
+        self._model_handler = model_handler
+        self.stdout = stdout if stdout is not None else sys.stdout
+        self.stderr = stderr if stderr is not None else sys.stderr
+        self._scratch = None
+        self._scratch_db = None
+    
+    def log(self, message: str = ""):
+        print(message, file=self.stdout)
+    
+    def scratch_dir(self) -> str:
+        if self._scratch is None:
+            self._scratch = tempfile.TemporaryDirectory(prefix="ogelo_test_")
+        return self._scratch.name
+    
+    def scratch_db(self):
+        if self._scratch_db is None:
+            from database import DatabaseManager
+            self._scratch_db = DatabaseManager(db_path=os.path.join(self.scratch_dir(), "test.db"))
+        return self._scratch_db
+    
+    def db(self):
+        return self._db if self._db is not None else self.scratch_db()
+    
+    def rag(self):
+        if self._rag is None:
+            from rag_system import RAGSystem
+            self._rag = RAGSystem(self.db())
+        return self._rag
+    
+    def model_handler(self):
+        if self._model_handler is None:
+            from model_handler import ModelHandler
+            self._model_handler = ModelHandler()
+        return self._model_handler
+    
+    def close(self):
+        if self._scratch is not None:
+            self._scratch.cleanup()
+            self._scratch = None
+
+def test_imports(suite: SuiteRun = None):
     """Test that all required modules can be imported."""
-    print("🧪 Testing imports...")
+    suite = suite or SuiteRun()
+    suite.log("🧪 Testing imports...")
     test_results = []
     
     modules_to_test = [
         ("Database Manager", "database"),
         ("PostgreSQL Manager", "postgres_database"), 
         ("Document Processor", "document_processor"),
+        ("Capabilities", "capabilities"),
         ("RAG System", "rag_system"),
         ("Model Handler", "model_handler"),
         ("Web Search Integration", "web_search_integration"),
@@ -35,14 +88,14 @@ def test_imports():
     
     return test_results
 
-def test_database_operations():
+def test_database_operations(suite: SuiteRun = None):
     """Test database functionality."""
-    print("🧪 Testing database operations...")
+    suite = suite or SuiteRun()
+    suite.log("🧪 Testing database operations...")
     test_results = []
     
     try:
-        from database import DatabaseManager
-        db = DatabaseManager()
+        db = suite.scratch_db()
         
         # Test initialization
         db.init_database()
@@ -60,22 +113,38 @@ def test_database_operations():
         db_type = db.get_database_type()
         test_results.append(f"✅ Database: Type detected ({db_type})")
         
+        test_results.append(_check_recent_conversation_order(suite))
+        
     except Exception as e:
         test_results.append(f"❌ Database: Error - {str(e)}")
         
     return test_results
 
-def test_document_processing():
+def _check_recent_conversation_order(suite: SuiteRun) -> str:
+    """Regression: a buffered batch shares one created_at, so recent conversations must still come newest first."""
+    from database import DatabaseManager, WriteBehindBuffer
+    
+    db = DatabaseManager(db_path=os.path.join(suite.scratch_dir(), "conversation_order.db"), use_postgres=False)
+    buffer = WriteBehindBuffer(db, max_rows=100)
+    for turn in range(8):
+        buffer.append(f"q{turn}", f"a{turn}")
+    buffer.flush(wait=True)
+    
+    recent = [user_msg for user_msg, _ in db.get_recent_conversations(3)]
+    if recent == ["q7", "q6", "q5"]:
+        return "✅ Database: Recent conversations newest first within a buffered batch"
+    return f"❌ Database: Recent conversations out of order ({recent})"
+
+def test_document_processing(suite: SuiteRun = None):
     """Test document processing capabilities."""
-    print("🧪 Testing document processing...")
+    suite = suite or SuiteRun()
+    suite.log("🧪 Testing document processing...")
     test_results = []
     
     try:
         from document_processor import DocumentProcessor, PDF_AVAILABLE, PANDAS_AVAILABLE, OCR_AVAILABLE, WEB_SCRAPING_AVAILABLE
-        from database import DatabaseManager
         
-        db = DatabaseManager()
-        processor = DocumentProcessor(db)
+        processor = DocumentProcessor(suite.db(), suite.rag())
         
         # Test availability flags
         test_results.append(f"📄 PDF Support: {'✅ Available' if PDF_AVAILABLE else '❌ Not available'}")
@@ -103,20 +172,16 @@ def test_document_processing():
         
     return test_results
 
-def test_rag_system():
+def test_rag_system(suite: SuiteRun = None):
     """Test RAG system functionality."""
-    print("🧪 Testing RAG system...")
+    suite = suite or SuiteRun()
+    suite.log("🧪 Testing RAG system...")
     test_results = []
     
     try:
-        from rag_system import RAGSystem, SENTENCE_TRANSFORMERS_AVAILABLE
-        from database import DatabaseManager
-        
-        db = DatabaseManager()
-        rag = RAGSystem(db)
+        rag = suite.rag()
         
         # Test embedding model loading
-        rag.load_embedding_model()
         is_loaded = rag.is_embedding_model_loaded()
         test_results.append(f"🧠 Embedding Model: {'✅ Loaded' if is_loaded else '⚠️ Simple fallback'}")
         
@@ -142,15 +207,16 @@ def test_rag_system():
         
     return test_results
 
-def test_model_handler():
+def test_model_handler(suite: SuiteRun = None):
     """Test model handler functionality."""
-    print("🧪 Testing model handler...")
+    suite = suite or SuiteRun()
+    suite.log("🧪 Testing model handler...")
     test_results = []
     
     try:
-        from model_handler import ModelHandler, TRANSFORMERS_AVAILABLE
+        from model_handler import TRANSFORMERS_AVAILABLE
         
-        handler = ModelHandler()
+        handler = suite.model_handler()
         
         # Test model availability
         test_results.append(f"🤖 Transformers: {'✅ Available' if TRANSFORMERS_AVAILABLE else '⚠️ Simple fallback'}")
@@ -187,9 +253,10 @@ def test_model_handler():
         
     return test_results
 
-def test_file_capabilities():
+def test_file_capabilities(suite: SuiteRun = None):
     """Test file processing capabilities."""
-    print("🧪 Testing file processing...")
+    suite = suite or SuiteRun()
+    suite.log("🧪 Testing file processing...")
     test_results = []
     
     # Test sample files exist
@@ -216,9 +283,10 @@ def test_file_capabilities():
     
     return test_results
 
-def test_web_integration():
+def test_web_integration(suite: SuiteRun = None):
     """Test web integration capabilities."""
-    print("🧪 Testing web integration...")
+    suite = suite or SuiteRun()
+    suite.log("🧪 Testing web integration...")
     test_results = []
     
     try:
@@ -253,9 +321,10 @@ def test_web_integration():
         
     return test_results
 
-def run_comprehensive_tests():
+def run_comprehensive_tests(suite: SuiteRun = None):
     """Run all tests and return results."""
-    print("🚀 Starting Comprehensive Test Suite for Ogelo RAG Chat Assistant\n")
+    suite = suite or SuiteRun()
+    suite.log("🚀 Starting Comprehensive Test Suite for Ogelo RAG Chat Assistant\n")
     
     all_results = []
     
@@ -271,39 +340,55 @@ def run_comprehensive_tests():
     ]
     
     for category_name, test_function in test_categories:
-        print(f"\n{'='*50}")
-        print(f"Testing: {category_name}")
-        print('='*50)
+        suite.log(f"\n{'='*50}")
+        suite.log(f"Testing: {category_name}")
+        suite.log('='*50)
         
         try:
-            results = test_function()
+            results = test_function(suite)
             all_results.extend(results)
             for result in results:
-                print(result)
+                suite.log(result)
         except Exception as e:
             error_msg = f"❌ {category_name}: Critical error - {str(e)}"
             all_results.append(error_msg)
-            print(error_msg)
-            traceback.print_exc()
+            suite.log(error_msg)
+            traceback.print_exc(file=suite.stderr)
     
     # Summary
-    print(f"\n{'='*50}")
-    print("TEST SUMMARY")
-    print('='*50)
+    suite.log(f"\n{'='*50}")
+    suite.log("TEST SUMMARY")
+    suite.log('='*50)
     
     success_count = len([r for r in all_results if r.startswith('✅')])
     warning_count = len([r for r in all_results if r.startswith('⚠️')])
     error_count = len([r for r in all_results if r.startswith('❌')])
     total_count = len(all_results)
     
-    print(f"Total Tests: {total_count}")
-    print(f"✅ Passed: {success_count}")
-    print(f"⚠️ Warnings: {warning_count}")
-    print(f"❌ Failed: {error_count}")
-    print(f"Success Rate: {(success_count/total_count*100):.1f}%")
+    suite.log(f"Total Tests: {total_count}")
+    suite.log(f"✅ Passed: {success_count}")
+    suite.log(f"⚠️ Warnings: {warning_count}")
+    suite.log(f"❌ Failed: {error_count}")
+    suite.log(f"Success Rate: {(success_count/total_count*100):.1f}%")
     
     return all_results
 
+def run(db=None, rag=None, model_handler=None) -> Tuple[bool, str, str]:
+    """Run the suite in-process against the given app objects and return (all_passed, stdout, stderr).
+    
+    Output goes to this run's own buffers rather than a redirected sys.stdout, which
+    other sessions' threads would write into as well.
+    """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    suite = SuiteRun(db=db, rag=rag, model_handler=model_handler, stdout=stdout, stderr=stderr)
+    try:
+        results = run_comprehensive_tests(suite)
+    finally:
+        suite.close()
+    
+    error_count = len([r for r in results if r.startswith('❌')])
+    return error_count == 0, stdout.getvalue(), stderr.getvalue()
+
 if __name__ == "__main__":
     results = run_comprehensive_tests()
     
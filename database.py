@@ -1,7 +1,12 @@
 import sqlite3
 import numpy as np
-import pickle
+from utils import chunk_hash, encode_embedding
+from vector_index import load_corpus_matrix, CorpusIndex
 import os
+import atexit
+import threading
+from concurrent.futures import wait as wait_futures
+from contextlib import contextmanager
 from typing import List, Tuple, Optional
 
 # Try to import PostgreSQL support
@@ -21,6 +26,21 @@ class DatabaseManager:
         
         self.use_postgres = use_postgres
         
+        # Counts shown in the sidebar on every rerun, cached until the tables change
+        self._doc_count_cache: Optional[int] = None
+        self._stats_cache: Optional[dict] = None
+        
+        # Write-behind buffers holding conversation rows not yet written. Reads merge their pending
+        # rows with the stored ones; the lock makes "write a batch, drop it from pending" atomic with
+        # respect to those reads, so a row is never counted twice or missed.
+        self._conversation_buffers = []
+        self._conversation_lock = threading.Lock()
+        
+        # In-process cache of the corpus index used by search_similar_chunks
+        self._corpus_lock = threading.Lock()
+        self._documents_version = 0
+        self._invalidate_corpus()
+        
         if self.use_postgres and POSTGRES_AVAILABLE:
             try:
                 self.postgres_manager = PostgreSQLManager()
@@ -36,39 +56,105 @@ class DatabaseManager:
             self.db_path = db_path
             self.init_database()
     
+    def _connect(self) -> sqlite3.Connection:
+        """Open the shared SQLite connection tuned for WAL mode."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-65536')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        # Memory-map up to 256 MiB of the file so large scans read pages without copying them
+        conn.execute('PRAGMA mmap_size=268435456')
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """Yield a cursor on the shared connection, committing on success and rolling back on error."""
+        with self._lock:
+            cursor = self._conn.cursor()
+            try:
+                yield cursor
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                cursor.close()
+    
     def init_database(self):
         """Initialize the SQLite database with required tables."""
         if self.use_postgres:
             return  # PostgreSQL initialization is handled in PostgreSQLManager
-            
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create documents table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS documents (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT NOT NULL,
-                content TEXT NOT NULL,
-                chunk_index INTEGER NOT NULL,
-                embedding BLOB NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
         
-        # Create conversations table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_message TEXT NOT NULL,
-                assistant_response TEXT NOT NULL,
-                context_used TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # One connection is shared by every call; the lock serializes access across threads
+        if getattr(self, '_conn', None) is None:
+            self._lock = threading.Lock()
+            self._conn = self._connect()
+            atexit.register(self._conn.close)
         
-        conn.commit()
-        conn.close()
+        with self._transaction() as cursor:
+            # WAL lets readers proceed during writes and avoids an fsync per commit
+            cursor.execute('PRAGMA journal_mode=WAL')
+            
+            # Create documents table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    filename TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    embedding BLOB NOT NULL,  -- raw float32 or int8 buffer, fixed dimension
+                    embedding_precision TEXT NOT NULL DEFAULT 'float32',
+                    embedding_scale REAL,  -- per-vector scale for int8 embeddings
+                    chunk_hash BLOB,  -- blake2b of content, NULL for rows stored before deduplication
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Older databases predate the precision/scale columns; float32 is what they stored
+            columns = {row[1] for row in cursor.execute('PRAGMA table_info(documents)')}
+            if 'embedding_precision' not in columns:
+                cursor.execute("ALTER TABLE documents ADD COLUMN embedding_precision TEXT NOT NULL DEFAULT 'float32'")
+            if 'embedding_scale' not in columns:
+                cursor.execute('ALTER TABLE documents ADD COLUMN embedding_scale REAL')
+            if 'chunk_hash' not in columns:
+                cursor.execute('ALTER TABLE documents ADD COLUMN chunk_hash BLOB')
+            
+            # A chunk is stored once per file; identical text in another file reuses its embedding.
+            # Earlier databases made chunk_hash unique across all files, which dropped the second file's rows.
+            cursor.execute('DROP INDEX IF EXISTS idx_documents_hash')
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_documents_filename_hash
+                ON documents(filename, chunk_hash)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_documents_chunk_hash
+                ON documents(chunk_hash)
+            ''')
+            
+            # Index filename so COUNT(DISTINCT filename) can scan the index instead of the table
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_documents_filename
+                ON documents(filename)
+            ''')
+            
+            # Create conversations table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_message TEXT NOT NULL,
+                    assistant_response TEXT NOT NULL,
+                    context_used TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # get_recent_conversations reads the newest rows straight off this index instead of sorting;
+            # id breaks ties between rows written in one batch, which share a timestamp
+            cursor.execute('DROP INDEX IF EXISTS idx_conversations_created_at')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversations_created_at_id
+                ON conversations(created_at DESC, id DESC)
+            ''')
     
     def store_document_chunk(self, filename: str, content: str, chunk_index: int, embedding: np.ndarray) -> bool:
         """Store a document chunk with its embedding."""
@@ -76,60 +162,156 @@ class DatabaseManager:
             return self.postgres_manager.store_document_chunk(filename, content, chunk_index, embedding)
             
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            # Serialize embedding (float32 by default, see EMBEDDING_PRECISION)
+            embedding_blob, precision, scale = encode_embedding(embedding)
             
-            # Serialize embedding
-            embedding_blob = pickle.dumps(embedding)
+            with self._transaction() as cursor:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO documents (filename, content, chunk_index, embedding, embedding_precision, embedding_scale, chunk_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (filename, content, chunk_index, embedding_blob, precision, scale, chunk_hash(content)))
+            self._corpus_rows_added()
+            return True
+        except Exception as e:
+            print(f"Error storing document chunk: {e}")
+            return False
+    
+    def store_document_chunks_bulk(self, filename: str, chunks: List[str], embeddings: np.ndarray, chunk_indices: List[int] = None) -> bool:
+        """Store all chunks of a document in a single transaction; chunks already stored under filename are skipped."""
+        if self.use_postgres:
+            return self.postgres_manager.store_document_chunks_bulk(filename, chunks, embeddings, chunk_indices)
             
-            cursor.execute('''
-                INSERT INTO documents (filename, content, chunk_index, embedding)
-                VALUES (?, ?, ?, ?)
-            ''', (filename, content, chunk_index, embedding_blob))
+        try:
+            if chunk_indices is None:
+                chunk_indices = range(len(chunks))
+            rows = [
+                (filename, chunk, chunk_index, *encode_embedding(embedding), chunk_hash(chunk))
+                for chunk, chunk_index, embedding in zip(chunks, chunk_indices, embeddings)
+            ]
             
-            conn.commit()
-            conn.close()
+            with self._transaction() as cursor:
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO documents (filename, content, chunk_index, embedding, embedding_precision, embedding_scale, chunk_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+            self._corpus_rows_added()
             return True
         except Exception as e:
-            print(f"Error storing document chunk: {e}")
+            print(f"Error storing document chunks: {e}")
+            return False
+    
+    def store_existing_chunks(self, filename: str, hashes: List[bytes], chunk_indices: List[int]) -> bool:
+        """Store rows for chunks whose text is already embedded, copying the stored embedding instead of recomputing it."""
+        if self.use_postgres:
+            return self.postgres_manager.store_existing_chunks(filename, hashes, chunk_indices)
+        
+        try:
+            with self._transaction() as cursor:
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO documents (filename, content, chunk_index, embedding, embedding_precision, embedding_scale, chunk_hash)
+                    SELECT ?, content, ?, embedding, embedding_precision, embedding_scale, chunk_hash
+                    FROM documents WHERE chunk_hash = ? LIMIT 1
+                ''', [(filename, chunk_index, digest) for digest, chunk_index in zip(hashes, chunk_indices)])
+            self._corpus_rows_added()
+            return True
+        except Exception as e:
+            print(f"Error storing existing chunks: {e}")
             return False
     
+    def get_existing_chunk_hashes(self, hashes: List[bytes]) -> set:
+        """Return the subset of chunk hashes that are already stored."""
+        if self.use_postgres:
+            return self.postgres_manager.get_existing_chunk_hashes(hashes)
+        
+        existing = set()
+        try:
+            with self._transaction() as cursor:
+                # Stay well under SQLite's bound-parameter limit
+                for start in range(0, len(hashes), 500):
+                    batch = hashes[start:start + 500]
+                    cursor.execute(
+                        f"SELECT chunk_hash FROM documents WHERE chunk_hash IN ({','.join('?' * len(batch))})",
+                        batch
+                    )
+                    existing.update(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            print(f"Error looking up chunk hashes: {e}")
+        return existing
+    
     def search_similar_chunks(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[str, str, float]]:
         """Search for similar document chunks using cosine similarity."""
         if self.use_postgres:
             return self.postgres_manager.search_similar_chunks(query_embedding, top_k)
             
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT filename, content, embedding FROM documents')
-            results = cursor.fetchall()
-            conn.close()
-            
-            if not results:
+            hits = self._ensure_corpus().search(query_embedding, top_k)
+            if not hits:
                 return []
             
-            similarities = []
-            for filename, content, embedding_blob in results:
-                # Deserialize embedding
-                embedding = pickle.loads(embedding_blob)
-                
-                # Calculate cosine similarity
-                similarity = self._cosine_similarity(query_embedding, embedding)
-                similarities.append((filename, content, similarity))
+            # Only the winning rows' text is read; the cached corpus holds ids and vectors
+            with self._transaction() as cursor:
+                cursor.execute(
+                    f"SELECT id, filename, content FROM documents WHERE id IN ({','.join('?' * len(hits))})",
+                    [row_id for row_id, _ in hits]
+                )
+                rows = {row_id: (filename, content) for row_id, filename, content in cursor.fetchall()}
             
-            # Sort by similarity and return top_k
-            similarities.sort(key=lambda x: x[2], reverse=True)
-            return similarities[:top_k]
+            return [(*rows[row_id], score) for row_id, score in hits if row_id in rows]
             
         except Exception as e:
             print(f"Error searching similar chunks: {e}")
             return []
     
-    def _cosine_similarity(self, a: np.ndarray, b: np.ndarray) -> float:
-        """Calculate cosine similarity between two vectors."""
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+    def get_documents_version(self) -> int:
+        """Return a counter that changes whenever the documents table is modified."""
+        if self.use_postgres:
+            return self.postgres_manager.get_documents_version()
+        return self._documents_version
+    
+    def _invalidate_corpus(self):
+        """Mark the cached corpus index and counts stale after rows are removed; the index is rebuilt."""
+        self._doc_count_cache = None
+        self._stats_cache = None
+        with self._corpus_lock:
+            self._corpus = None
+            self._dirty = True
+            self._rows_added = False
+            self._documents_version += 1
+    
+    def _corpus_rows_added(self):
+        """Mark counts stale after an insert; the cached index only picks up the new rows."""
+        self._doc_count_cache = None
+        self._stats_cache = None
+        with self._corpus_lock:
+            self._rows_added = True
+            self._documents_version += 1
+    
+    def _ensure_corpus(self) -> CorpusIndex:
+        """Return the cached corpus index, reloading it after deletes and extending it after inserts."""
+        with self._corpus_lock:
+            if self._dirty:
+                with self._transaction() as cursor:
+                    cursor.execute('SELECT COUNT(*) FROM documents')
+                    n_rows = cursor.fetchone()[0]
+                    
+                    # Decode embeddings batch by batch into one float32 matrix; chunk text stays on disk
+                    cursor.execute('SELECT id, embedding, embedding_precision, embedding_scale FROM documents ORDER BY id')
+                    self._corpus = CorpusIndex(*load_corpus_matrix(cursor, n_rows))
+                
+                self._dirty = False
+                self._rows_added = False
+            elif self._rows_added:
+                # AUTOINCREMENT ids only grow, so new rows are the ones past the highest cached id
+                with self._transaction() as cursor:
+                    cursor.execute(
+                        'SELECT id, embedding, embedding_precision, embedding_scale FROM documents WHERE id > ? ORDER BY id',
+                        (int(self._corpus.ids.max(initial=0)),)
+                    )
+                    self._corpus.extend(*load_corpus_matrix(cursor, 0))
+                
+                self._rows_added = False
+            
+            return self._corpus
     
     def store_conversation(self, user_message: str, assistant_response: str, context_used: str = None) -> bool:
         """Store a conversation exchange."""
@@ -137,33 +319,47 @@ class DatabaseManager:
             return self.postgres_manager.store_conversation(user_message, assistant_response, context_used)
             
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO conversations (user_message, assistant_response, context_used)
-                VALUES (?, ?, ?)
-            ''', (user_message, assistant_response, context_used))
-            
-            conn.commit()
-            conn.close()
+            with self._transaction() as cursor:
+                cursor.execute('''
+                    INSERT INTO conversations (user_message, assistant_response, context_used)
+                    VALUES (?, ?, ?)
+                ''', (user_message, assistant_response, context_used))
+            self._stats_cache = None
             return True
         except Exception as e:
             print(f"Error storing conversation: {e}")
             return False
     
+    def store_conversations_bulk(self, rows: List[Tuple[str, str, Optional[str]]]) -> bool:
+        """Store many (user_message, assistant_response, context_used) rows in a single transaction."""
+        if self.use_postgres:
+            return self.postgres_manager.store_conversations_bulk(rows)
+            
+        try:
+            with self._transaction() as cursor:
+                cursor.executemany('''
+                    INSERT INTO conversations (user_message, assistant_response, context_used)
+                    VALUES (?, ?, ?)
+                ''', rows)
+            self._stats_cache = None
+            return True
+        except Exception as e:
+            print(f"Error storing conversations: {e}")
+            return False
+    
     def get_document_count(self) -> int:
         """Get the total number of unique documents."""
         if self.use_postgres:
             return self.postgres_manager.get_document_count()
             
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        if self._doc_count_cache is not None:
+            return self._doc_count_cache
             
-            cursor.execute('SELECT COUNT(DISTINCT filename) FROM documents')
-            count = cursor.fetchone()[0]
-            conn.close()
+        try:
+            with self._transaction() as cursor:
+                cursor.execute('SELECT COUNT(DISTINCT filename) FROM documents')
+                count = cursor.fetchone()[0]
+            self._doc_count_cache = count
             return count
         except Exception as e:
             print(f"Error getting document count: {e}")
@@ -175,35 +371,49 @@ class DatabaseManager:
             return self.postgres_manager.clear_documents()
             
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('DELETE FROM documents')
-            conn.commit()
-            conn.close()
+            with self._transaction() as cursor:
+                cursor.execute('DELETE FROM documents')
+            self._invalidate_corpus()
             return True
         except Exception as e:
             print(f"Error clearing documents: {e}")
             return False
     
+    def register_conversation_buffer(self, buffer: 'WriteBehindBuffer'):
+        """Have conversation reads include buffer's pending rows, so they never miss buffered turns."""
+        self._conversation_buffers.append(buffer)
+    
+    def _pending_conversations(self) -> List[Tuple[str, str, Optional[str]]]:
+        """Rows buffered but not yet written, newest first; call with _conversation_lock held."""
+        pending = []
+        for buffer in self._conversation_buffers:
+            pending.extend(buffer.pending_rows())
+        pending.reverse()
+        return pending
+    
     def get_recent_conversations(self, limit: int = 10) -> List[Tuple[str, str]]:
-        """Get recent conversations."""
+        """Get recent conversations, including turns still waiting in a write-behind buffer."""
+        with self._conversation_lock:
+            pending = [(user_message, assistant_response)
+                       for user_message, assistant_response, _ in self._pending_conversations()[:limit]]
+            if len(pending) == limit:
+                return pending
+            return pending + self._stored_recent_conversations(limit - len(pending))
+    
+    def _stored_recent_conversations(self, limit: int) -> List[Tuple[str, str]]:
         if self.use_postgres:
             return self.postgres_manager.get_recent_conversations(limit)
             
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT user_message, assistant_response 
-                FROM conversations 
-                ORDER BY created_at DESC 
-                LIMIT ?
-            ''', (limit,))
-            
-            results = cursor.fetchall()
-            conn.close()
+            with self._transaction() as cursor:
+                cursor.execute('''
+                    SELECT user_message, assistant_response 
+                    FROM conversations 
+                    ORDER BY created_at DESC, id DESC 
+                    LIMIT ?
+                ''', (limit,))
+                
+                results = cursor.fetchall()
             return results
         except Exception as e:
             print(f"Error getting recent conversations: {e}")
@@ -214,33 +424,129 @@ class DatabaseManager:
         return "PostgreSQL" if self.use_postgres else "SQLite"
     
     def get_database_stats(self) -> dict:
-        """Get comprehensive database statistics."""
+        """Get comprehensive database statistics, counting buffered conversations."""
+        with self._conversation_lock:
+            stats = self._stored_database_stats()
+            if stats:
+                stats['total_conversations'] += len(self._pending_conversations())
+            return stats
+    
+    def _stored_database_stats(self) -> dict:
         if self.use_postgres:
             return self.postgres_manager.get_database_stats()
         
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Get document stats
-            cursor.execute('SELECT COUNT(DISTINCT filename) FROM documents')
-            unique_docs = cursor.fetchone()[0]
+        if self._stats_cache is not None:
+            return dict(self._stats_cache)
             
-            cursor.execute('SELECT COUNT(*) FROM documents')
-            total_chunks = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM conversations')
-            total_conversations = cursor.fetchone()[0]
-            
-            conn.close()
+        try:
+            with self._transaction() as cursor:
+                # Get document stats
+                cursor.execute('SELECT COUNT(DISTINCT filename) FROM documents')
+                unique_docs = cursor.fetchone()[0]
+                
+                cursor.execute('SELECT COUNT(*) FROM documents')
+                total_chunks = cursor.fetchone()[0]
+                
+                cursor.execute('SELECT COUNT(*) FROM conversations')
+                total_conversations = cursor.fetchone()[0]
             
-            return {
+            self._stats_cache = {
                 'unique_documents': unique_docs,
                 'total_chunks': total_chunks,
                 'total_conversations': total_conversations,
                 'database_type': 'SQLite'
             }
+            return dict(self._stats_cache)
             
         except Exception as e:
             print(f"Error getting database stats: {e}")
             return {}
+
+
+class WriteBehindBuffer:
+    """Buffer conversation rows and write them to the database in batches.
+    
+    Rows are flushed when max_rows accumulate, max_delay seconds after the first
+    buffered row, or at interpreter exit. Until a batch is written, the database
+    serves its rows to conversation reads from pending_rows().
+    """
+    
+    def __init__(self, db_manager: DatabaseManager, max_rows: int = 8, max_delay: float = 5.0, executor=None):
+        self.db_manager = db_manager
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.executor = executor
+        self._rows = []
+        self._lock = threading.Lock()
+        self._timer = None
+        # Batches taken from _rows but not yet written, and the executor futures writing them
+        self._unwritten = []
+        self._in_flight = set()
+        atexit.register(self.flush, wait=True)
+        db_manager.register_conversation_buffer(self)
+    
+    def append(self, user_message: str, assistant_response: str, context_used: str = None):
+        """Queue a conversation exchange for writing."""
+        with self._lock:
+            self._rows.append((user_message, assistant_response, context_used))
+            if len(self._rows) < self.max_rows:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            rows = self._take_rows()
+        self._submit(rows)
+    
+    def flush(self, wait: bool = False):
+        """Write all buffered rows; with wait=True the write happens on the calling thread.
+        
+        Waiting also covers batches already handed to the executor, so every row
+        appended before the call is in the database when it returns.
+        """
+        with self._lock:
+            rows = self._take_rows()
+            in_flight = list(self._in_flight)
+        if wait:
+            wait_futures(in_flight)
+            if rows:
+                self._write(rows)
+        elif rows:
+            self._submit(rows)
+    
+    def pending_rows(self) -> list:
+        """Rows appended but not yet written, oldest first."""
+        with self._lock:
+            return [row for batch in self._unwritten for row in batch] + self._rows
+    
+    def _take_rows(self) -> list:
+        rows, self._rows = self._rows, []
+        if rows:
+            self._unwritten.append(rows)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return rows
+    
+    def _submit(self, rows: list):
+        if self.executor is not None:
+            with self._lock:
+                future = self.executor.submit(self._write, rows)
+                self._in_flight.add(future)
+            future.add_done_callback(self._forget)
+        else:
+            self._write(rows)
+    
+    def _forget(self, future):
+        with self._lock:
+            self._in_flight.discard(future)
+    
+    def _write(self, rows: list):
+        with self.db_manager._conversation_lock:
+            try:
+                if not self.db_manager.store_conversations_bulk(rows):
+                    print(f"Failed to store {len(rows)} buffered conversations")
+            except Exception as e:
+                print(f"Error flushing buffered conversations: {e}")
+            with self._lock:
+                self._unwritten = [batch for batch in self._unwritten if batch is not rows]
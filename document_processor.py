@@ -1,5 +1,6 @@
 try:
     import PyPDF2
+    from pdf_worker import extract_page_texts, extract_pdf_file_pages
     PDF_AVAILABLE = True
 except ImportError:
     PDF_AVAILABLE = False
@@ -17,27 +18,85 @@ try:
 except ImportError:
     OCR_AVAILABLE = False
 
+# Optional in-process Tesseract bindings: one engine stays loaded instead of a subprocess per image
+try:
+    import tesserocr
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     from bs4 import BeautifulSoup
     import trafilatura
     WEB_SCRAPING_AVAILABLE = True
 except ImportError:
     WEB_SCRAPING_AVAILABLE = False
 
+# lxml parses and walks HTML in C; BeautifulSoup's html.parser is the pure-Python fallback
+try:
+    from lxml import html as lxml_html
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+import bisect
+import codecs
 import io
+import os
 import re
-from typing import List
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
 from database import DatabaseManager
 from rag_system import RAGSystem
+from utils import chunk_hash
+from capabilities import IMAGE_EXTENSIONS
+
+# Any run of whitespace, collapsed to one space in scraped page text
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# URL scheme prefix and the characters that are not safe in a generated filename
+URL_SCHEME_PATTERN = re.compile(r'^https?://')
+UNSAFE_FILENAME_PATTERN = re.compile(r'[^\w\-_\.]')
+
+# Most bytes of a page body downloaded by the BeautifulSoup/lxml fallback
+MAX_PAGE_BYTES = 8 * 1024 * 1024
+
+# Longest image side passed to Tesseract; larger scans are downscaled before OCR
+OCR_MAX_DIMENSION = 2400
+
+# PDFs with fewer pages are extracted in-process; handing pages to workers would outweigh the gain
+PDF_PARALLEL_MIN_PAGES = 64
 
 class DocumentProcessor:
-    def __init__(self, db_manager: DatabaseManager):
-        """Initialize document processor with database manager."""
+    def __init__(self, db_manager: DatabaseManager, rag_system: RAGSystem = None):
+        """Initialize document processor with database manager and an optional shared RAG system."""
         self.db_manager = db_manager
-        self.rag_system = RAGSystem(db_manager)
+        self.rag_system = rag_system if rag_system is not None else RAGSystem(db_manager)
         self.chunk_size = 500  # Characters per chunk
         self.chunk_overlap = 50  # Overlap between chunks
+        self._http = self._build_http_session() if WEB_SCRAPING_AVAILABLE else None
+        self._tess_api = None
+        self._tess_lock = threading.Lock()
+        self._pdf_pool = None
+        self._pdf_pool_lock = threading.Lock()
+    
+    @staticmethod
+    def _build_http_session():
+        """HTTP session whose pooled keep-alive connections are reused across URL fetches."""
+        session = requests.Session()
+        session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        })
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.3))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
     
     def process_document(self, uploaded_file) -> bool:
         """Process an uploaded document and store it in the database."""
@@ -52,35 +111,13 @@ class DocumentProcessor:
                 text = self._extract_text_from_txt(uploaded_file)
             elif file_extension == 'csv':
                 text = self._extract_text_from_csv(uploaded_file)
-            elif file_extension in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff']:
+            elif file_extension in IMAGE_EXTENSIONS:
                 text = self._extract_text_from_image(uploaded_file)
             else:
                 print(f"Unsupported file type: {file_extension}")
                 return False
             
-            if not text.strip():
-                print("No text content found in the document")
-                return False
-            
-            # Split text into chunks
-            chunks = self._split_text_into_chunks(text)
-            
-            # Process and store each chunk
-            for i, chunk in enumerate(chunks):
-                # Get embedding for the chunk
-                embedding = self.rag_system.get_embedding(chunk)
-                
-                # Store chunk in database
-                success = self.db_manager.store_document_chunk(
-                    filename, chunk, i, embedding
-                )
-                
-                if not success:
-                    print(f"Failed to store chunk {i} of {filename}")
-                    return False
-            
-            print(f"Successfully processed {filename} with {len(chunks)} chunks")
-            return True
+            return self._store_text(filename, text)
             
         except Exception as e:
             print(f"Error processing document: {e}")
@@ -88,30 +125,71 @@ class DocumentProcessor:
             traceback.print_exc()
             return False
     
+    def _store_text(self, filename: str, text: str) -> bool:
+        """Chunk extracted text and store it under filename."""
+        if not text.strip():
+            print("No text content found in the document")
+            return False
+        
+        # Split text into chunks
+        chunks = self._split_text_into_chunks(text)
+        
+        if not self._store_chunks(filename, chunks):
+            print(f"Failed to store chunks of {filename}")
+            return False
+        
+        print(f"Successfully processed {filename} with {len(chunks)} chunks")
+        return True
+    
+    def _store_chunks(self, filename: str, chunks: List[str]) -> bool:
+        """Embed and store chunks in one batch, reusing the embeddings of text already in the knowledge base."""
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+        existing = self.db_manager.get_existing_chunk_hashes(hashes)
+        
+        # First occurrence of each chunk, keeping its position in the document
+        new_chunks = {}
+        known_chunks = {}
+        for i, (chunk, digest) in enumerate(zip(chunks, hashes)):
+            if digest in existing:
+                known_chunks.setdefault(digest, i)
+            elif digest not in new_chunks:
+                new_chunks[digest] = (i, chunk)
+        
+        # Text stored before (possibly under another filename) still gets a row for this file
+        if known_chunks and not self.db_manager.store_existing_chunks(filename, list(known_chunks), list(known_chunks.values())):
+            return False
+        
+        if not new_chunks:
+            print(f"All {len(chunks)} chunks of {filename} were already embedded")
+            return True
+        
+        indices = [i for i, _ in new_chunks.values()]
+        texts = [chunk for _, chunk in new_chunks.values()]
+        embeddings = self.rag_system.get_embeddings(texts)
+        return self.db_manager.store_document_chunks_bulk(filename, texts, embeddings, indices)
+    
     def _extract_text_from_pdf(self, uploaded_file) -> str:
         """Extract text from a PDF file."""
         if not PDF_AVAILABLE:
             return "PDF processing is not available. Please install PyPDF2 or upload a text file instead."
             
         try:
-            # Reset file pointer and read the PDF file
+            # Reset file pointer; PyPDF2 reads the seekable upload on demand instead of from a copy
             uploaded_file.seek(0)
-            pdf_content = uploaded_file.read()
+            pdf_reader = PyPDF2.PdfReader(uploaded_file)
             
-            # Create PDF reader from bytes
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
+            # Extract text from each page, spreading longer documents across processes
+            n_pages = len(pdf_reader.pages)
+            if n_pages < PDF_PARALLEL_MIN_PAGES:
+                page_texts = extract_page_texts(pdf_reader, range(n_pages))
+            else:
+                uploaded_file.seek(0)
+                page_texts = self._extract_pdf_pages_parallel(uploaded_file, pdf_reader, n_pages)
             
             text_parts = []
-            
-            # Extract text from each page
-            for page_num, page in enumerate(pdf_reader.pages):
-                try:
-                    page_text = page.extract_text()
-                    if page_text.strip():  # Only add non-empty pages
-                        text_parts.append(f"Page {page_num + 1}:\n{page_text}")
-                except Exception as page_error:
-                    print(f"Error extracting text from page {page_num + 1}: {page_error}")
-                    continue
+            for page_num, page_text in page_texts:
+                if page_text and page_text.strip():  # Only add non-empty pages
+                    text_parts.append(f"Page {page_num + 1}:\n{page_text}")
             
             if not text_parts:
                 return "No readable text found in the PDF. The PDF might be image-based or corrupted."
@@ -127,12 +205,10 @@ class DocumentProcessor:
                 except:
                     pass  # Skip metadata if not accessible
             
-            # Combine all text
-            full_text = ""
+            # Combine all text: one join over the pages, then a single prefix for the metadata
+            full_text = "\n\n".join(text_parts)
             if metadata_info:
-                full_text += "PDF Information:\n" + "\n".join(metadata_info) + "\n\n"
-            
-            full_text += "\n\n".join(text_parts)
+                full_text = "PDF Information:\n" + "\n".join(metadata_info) + "\n\n" + full_text
             
             print(f"Successfully extracted text from PDF: {len(text_parts)} pages, {len(full_text)} characters")
             return full_text
@@ -142,24 +218,50 @@ class DocumentProcessor:
             print(error_msg)
             return f"Failed to process PDF file: {str(e)}. Please ensure the PDF is not corrupted or password-protected."
     
+    def _get_pdf_pool(self) -> ProcessPoolExecutor:
+        """The long-lived PDF worker pool, started on first use.
+        
+        Workers are spawned rather than forked, so they never inherit the server's torch
+        threads, and they import only pdf_worker.
+        """
+        with self._pdf_pool_lock:
+            if self._pdf_pool is None:
+                self._pdf_pool = ProcessPoolExecutor(
+                    max_workers=os.cpu_count() or 1,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._pdf_pool
+    
+    def _extract_pdf_pages_parallel(self, uploaded_file, pdf_reader, n_pages: int) -> List[Tuple[int, Optional[str]]]:
+        """Extract page text in worker processes, each parsing its own reader over an interleaved share of pages."""
+        pool = self._get_pdf_pool()
+        workers = min(os.cpu_count() or 1, n_pages)
+        page_ranges = [range(start, n_pages, workers) for start in range(workers)]
+        path = None
+        try:
+            # Workers open the PDF from one temporary file instead of each receiving a pickled copy
+            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+                path = pdf_file.name
+                pdf_file.write(uploaded_file.read())
+            results = pool.map(extract_pdf_file_pages, [path] * workers, page_ranges)
+            return sorted(page for pages in results for page in pages)
+        except Exception as e:
+            print(f"Parallel PDF extraction failed, extracting serially: {e}")
+            return extract_page_texts(pdf_reader, range(n_pages))
+        finally:
+            if path is not None:
+                os.remove(path)
+    
     def _extract_text_from_txt(self, uploaded_file) -> str:
         """Extract text from a text file."""
         try:
-            # Reset file pointer and read content
+            # Reset file pointer and decode as UTF-8, falling back to latin-1 (which accepts any byte)
             uploaded_file.seek(0)
-            content = uploaded_file.read()
-            
-            # Try to decode as UTF-8, fallback to latin-1 if that fails
-            if isinstance(content, bytes):
-                try:
-                    text = content.decode('utf-8')
-                except UnicodeDecodeError:
-                    try:
-                        text = content.decode('latin-1')
-                    except UnicodeDecodeError:
-                        text = content.decode('utf-8', errors='ignore')
-            else:
-                text = content
+            try:
+                text = self._decode_stream(uploaded_file, 'utf-8')
+            except UnicodeDecodeError:
+                uploaded_file.seek(0)
+                text = self._decode_stream(uploaded_file, 'latin-1')
                 
             if not text.strip():
                 return "The text file appears to be empty."
@@ -172,6 +274,20 @@ class DocumentProcessor:
             print(error_msg)
             return f"Failed to process text file: {str(e)}"
     
+    @staticmethod
+    def _decode_stream(stream, encoding: str, block_size: int = 1 << 20) -> str:
+        """Decode a file block by block so the raw bytes are never held in memory all at once."""
+        decoder = codecs.getincrementaldecoder(encoding)()
+        parts = []
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            # Text-mode streams are already decoded
+            parts.append(block if isinstance(block, str) else decoder.decode(block))
+        parts.append(decoder.decode(b'', final=True))
+        return "".join(parts)
+    
     def _extract_text_from_csv(self, uploaded_file) -> str:
         """Extract text from a CSV file."""
         if not PANDAS_AVAILABLE:
@@ -193,27 +309,24 @@ class DocumentProcessor:
             text_parts.append(f"Total rows: {len(df)}")
             text_parts.append("\nData Content:")
             
-            # Add each row as structured text
-            for index, row in df.iterrows():
-                row_text = f"Row {index + 1}: "
-                row_items = []
-                for col in df.columns:
-                    value = str(row[col]) if pd.notna(row[col]) else "N/A"
-                    row_items.append(f"{col}: {value}")
-                row_text += ", ".join(row_items)
-                text_parts.append(row_text)
-                
-                # Limit to first 100 rows to avoid memory issues
-                if index >= 99:
-                    text_parts.append(f"... and {len(df) - 100} more rows")
-                    break
+            # Add each row as structured text, limited to the first 100 rows to avoid memory issues;
+            # cells are stringified column-wise rather than boxed one by one through iterrows
+            head = df.head(100)
+            cells = head.astype(str).where(head.notna(), "N/A")
+            labelled = [f"{col}: " + cells[col] for col in cells.columns]
+            row_items = labelled[0].str.cat(labelled[1:], sep=", ")
+            text_parts.extend(("Row " + (head.index + 1).astype(str) + ": " + row_items).tolist())
+            if len(df) >= 100:
+                text_parts.append(f"... and {len(df) - 100} more rows")
             
             # Add summary statistics for numeric columns
             numeric_cols = df.select_dtypes(include=['number']).columns
             if len(numeric_cols) > 0:
                 text_parts.append("\nNumeric Summary:")
+                # One aggregation pass over all numeric columns; describe() would also compute quartiles per column
+                summary = df[numeric_cols].agg(['mean', 'min', 'max'])
                 for col in numeric_cols:
-                    stats = df[col].describe()
+                    stats = summary[col]
                     text_parts.append(f"{col}: mean={stats['mean']:.2f}, min={stats['min']:.2f}, max={stats['max']:.2f}")
             
             print(f"Successfully extracted text from CSV: {len(df)} rows, {len(text_parts)} chunks")
@@ -228,43 +341,109 @@ class DocumentProcessor:
             return "OCR processing is not available. Please install Pillow and pytesseract or upload a text file instead."
             
         try:
-            # Reset file pointer and read image
-            uploaded_file.seek(0)
-            image_data = uploaded_file.read()
-            
-            # Open image with PIL
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            image, image_info = self._prepare_image_for_ocr(uploaded_file)
             
             # Extract text using OCR
-            extracted_text = pytesseract.image_to_string(image)
-            
-            if not extracted_text.strip():
-                return "No readable text found in the image. The image might not contain text or the text might not be clear enough for OCR."
-            
-            # Add image metadata
-            image_info = [
-                f"Image Information:",
-                f"Format: {image.format}",
-                f"Size: {image.size[0]}x{image.size[1]} pixels",
-                f"Mode: {image.mode}",
-                "",
-                "Extracted Text:"
-            ]
-            
-            full_text = "\n".join(image_info) + "\n" + extracted_text.strip()
-            
-            print(f"Successfully extracted text from image: {len(extracted_text)} characters")
-            return full_text
+            extracted_text = self._ocr_image(image)
+            return self._format_ocr_text(image_info, extracted_text)
             
         except Exception as e:
             error_msg = f"Error extracting text from image: {e}"
             print(error_msg)
             return f"Failed to process image file: {str(e)}. Please ensure the image is not corrupted and contains readable text."
     
+    def _prepare_image_for_ocr(self, uploaded_file):
+        """Open an uploaded image and return it ready for Tesseract, with its original metadata lines."""
+        # Reset file pointer and read image
+        uploaded_file.seek(0)
+        image_data = uploaded_file.read()
+        
+        # Open image with PIL
+        image = Image.open(io.BytesIO(image_data))
+        
+        # Add image metadata
+        image_info = [
+            f"Image Information:",
+            f"Format: {image.format}",
+            f"Size: {image.size[0]}x{image.size[1]} pixels",
+            f"Mode: {image.mode}",
+            "",
+            "Extracted Text:"
+        ]
+        
+        # Tesseract binarizes internally: a single grayscale channel is a third of the RGB bytes,
+        # and its runtime scales with pixel count, so oversized scans are downscaled first
+        if image.mode != 'L':
+            image = image.convert('L')
+        if max(image.size) > OCR_MAX_DIMENSION:
+            image.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)
+        
+        return image, image_info
+    
+    def _ocr_image(self, image) -> str:
+        """OCR one prepared image, reusing a loaded tesserocr engine when available."""
+        if TESSEROCR_AVAILABLE and self._tess_api is not False:
+            try:
+                # The engine is not thread-safe and is shared by every session
+                with self._tess_lock:
+                    if self._tess_api is None:
+                        self._tess_api = tesserocr.PyTessBaseAPI()
+                    self._tess_api.SetImage(image)
+                    return self._tess_api.GetUTF8Text()
+            except Exception as e:
+                print(f"tesserocr unavailable, using pytesseract: {e}")
+                self._tess_api = False
+        return pytesseract.image_to_string(image)
+    
+    def _format_ocr_text(self, image_info: List[str], extracted_text: str) -> str:
+        """Prefix OCR output with the image metadata, or explain that nothing was recognized."""
+        if not extracted_text.strip():
+            return "No readable text found in the image. The image might not contain text or the text might not be clear enough for OCR."
+        
+        full_text = "\n".join(image_info) + "\n" + extracted_text.strip()
+        
+        print(f"Successfully extracted text from image: {len(extracted_text)} characters")
+        return full_text
+    
+    def process_image_batch(self, uploaded_files) -> List[bool]:
+        """OCR several images in one Tesseract run and store each as its own document.
+        
+        Tesseract loads its model once per process, so passing a list file of image paths
+        amortizes initialization across the batch. Single images, batch failures and hosts
+        with a persistent tesserocr engine go through process_document one file at a time.
+        """
+        if not OCR_AVAILABLE or len(uploaded_files) < 2 or (TESSEROCR_AVAILABLE and self._tess_api is not False):
+            return [self.process_document(uploaded_file) for uploaded_file in uploaded_files]
+        
+        try:
+            texts = self._extract_text_from_image_batch(uploaded_files)
+        except Exception as e:
+            print(f"Batch OCR failed, processing images one at a time: {e}")
+            return [self.process_document(uploaded_file) for uploaded_file in uploaded_files]
+        
+        return [self._store_text(uploaded_file.name, text) for uploaded_file, text in zip(uploaded_files, texts)]
+    
+    def _extract_text_from_image_batch(self, uploaded_files) -> List[str]:
+        """Run Tesseract once over a list file naming every image; pages come back separated by form feeds."""
+        with tempfile.TemporaryDirectory() as scratch:
+            paths, infos = [], []
+            for i, uploaded_file in enumerate(uploaded_files):
+                image, image_info = self._prepare_image_for_ocr(uploaded_file)
+                path = os.path.join(scratch, f"{i}.png")
+                image.save(path)
+                paths.append(path)
+                infos.append(image_info)
+            
+            list_path = os.path.join(scratch, "images.txt")
+            with open(list_path, "w") as f:
+                f.write("\n".join(paths) + "\n")
+            
+            pages = pytesseract.image_to_string(list_path).split("\f")
+        
+        if len(pages) < len(uploaded_files):
+            raise ValueError(f"expected {len(uploaded_files)} OCR pages, got {len(pages)}")
+        return [self._format_ocr_text(image_info, page) for image_info, page in zip(infos, pages)]
+    
     def process_url(self, url: str) -> bool:
         """Process content from a URL and store it in the database."""
         if not WEB_SCRAPING_AVAILABLE:
@@ -311,19 +490,9 @@ class DocumentProcessor:
             # Split text into chunks
             chunks = self._split_text_into_chunks(full_text)
             
-            # Process and store each chunk
-            for i, chunk in enumerate(chunks):
-                # Get embedding for the chunk
-                embedding = self.rag_system.get_embedding(chunk)
-                
-                # Store chunk in database
-                success = self.db_manager.store_document_chunk(
-                    filename, chunk, i, embedding
-                )
-                
-                if not success:
-                    print(f"Failed to store chunk {i} of {filename}")
-                    return False
+            if not self._store_chunks(filename, chunks):
+                print(f"Failed to store chunks of {filename}")
+                return False
             
             print(f"Successfully processed URL {url} with {len(chunks)} chunks")
             return True
@@ -337,30 +506,40 @@ class DocumentProcessor:
     def _extract_with_beautifulsoup(self, url: str) -> str:
         """Fallback content extraction using requests and BeautifulSoup."""
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
-            response = requests.get(url, headers=headers, timeout=30)
+            # Headers arrive before the body, so binary assets are rejected without downloading them
+            response = self._http.get(url, timeout=30, stream=True)
             response.raise_for_status()
             
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Remove script and style elements
-            for script in soup(["script", "style"]):
-                script.decompose()
-            
-            # Get text content
-            text = soup.get_text()
+            content_type = response.headers.get('Content-Type', '').lower()
+            if content_type and not (content_type.startswith('text/') or 'html' in content_type or 'xml' in content_type):
+                response.close()
+                print(f"Skipping non-text content at {url}: {content_type}")
+                return ""
+            
+            content = self._read_capped(response, MAX_PAGE_BYTES)
+            
+            if LXML_AVAILABLE:
+                # Remove script and style elements with one XPath query; drop_tree keeps their tail text
+                tree = lxml_html.fromstring(content)
+                for element in tree.xpath('//script|//style'):
+                    element.drop_tree()
+                page_text = tree.text_content()
+                title = tree.find('.//title')
+                title_text = title.text_content().strip() if title is not None else "No title"
+            else:
+                soup = BeautifulSoup(content, 'html.parser')
+                
+                # Remove script and style elements
+                for script in soup(["script", "style"]):
+                    script.decompose()
+                page_text = soup.get_text()
+                title = soup.find('title')
+                title_text = title.get_text().strip() if title else "No title"
             
-            # Clean up whitespace
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = ' '.join(chunk for chunk in chunks if chunk)
+            # Get text content with whitespace collapsed in one regex pass
+            text = WHITESPACE_PATTERN.sub(' ', page_text).strip()
             
             # Add metadata
-            title = soup.find('title')
-            title_text = title.get_text().strip() if title else "No title"
             
             metadata = [
                 f"URL Content: {url}",
@@ -376,11 +555,25 @@ class DocumentProcessor:
             print(f"Error with BeautifulSoup extraction: {e}")
             return ""
     
+    @staticmethod
+    def _read_capped(response, max_bytes: int) -> bytes:
+        """Read a streamed response body, stopping once max_bytes have arrived."""
+        body = bytearray()
+        try:
+            for block in response.iter_content(chunk_size=65536):
+                body += block
+                if len(body) >= max_bytes:
+                    print(f"Page body truncated at {max_bytes} bytes")
+                    break
+        finally:
+            response.close()
+        return bytes(body[:max_bytes])
+    
     def _url_to_filename(self, url: str) -> str:
         """Convert URL to a safe filename."""
         # Remove protocol and clean up
-        filename = re.sub(r'^https?://', '', url)
-        filename = re.sub(r'[^\w\-_\.]', '_', filename)
+        filename = URL_SCHEME_PATTERN.sub('', url)
+        filename = UNSAFE_FILENAME_PATTERN.sub('_', filename)
         filename = filename[:100]  # Limit length
         return f"url_{filename}.txt"
     
@@ -389,27 +582,39 @@ class DocumentProcessor:
         if len(text) <= self.chunk_size:
             return [text]
         
+        # Boundary offsets are collected once; each chunk then finds its break by binary search
+        sentence_ends = [m.start() for m in re.finditer(r'\.', text)]
+        word_ends = [m.start() for m in re.finditer(' ', text)]
+        
         chunks = []
         start = 0
+        previous_start = 0
         
         while start < len(text):
             end = start + self.chunk_size
             
+            # A tail shorter than two overlaps is mostly text the previous chunk already holds;
+            # fold it into that chunk rather than embedding a near-duplicate fragment on its own
+            if chunks and len(text) - start < 2 * self.chunk_overlap:
+                chunks[-1] = text[previous_start:].strip()
+                break
+            
             # If this is not the last chunk, try to break at a sentence or word boundary
             if end < len(text):
                 # Look for sentence endings
-                sentence_end = text.rfind('.', start, end)
+                sentence_end = self._last_boundary_before(sentence_ends, end)
                 if sentence_end > start:
                     end = sentence_end + 1
                 else:
                     # Look for word boundaries
-                    word_end = text.rfind(' ', start, end)
+                    word_end = self._last_boundary_before(word_ends, end)
                     if word_end > start:
                         end = word_end
             
             chunk = text[start:end].strip()
             if chunk:
                 chunks.append(chunk)
+                previous_start = start
             
             # Move start position with overlap
             start = end - self.chunk_overlap
@@ -419,3 +624,9 @@ class DocumentProcessor:
                 start = end
         
         return chunks
+    
+    @staticmethod
+    def _last_boundary_before(boundaries: List[int], end: int) -> int:
+        """Return the largest offset in sorted boundaries that is below end, or -1."""
+        i = bisect.bisect_left(boundaries, end)
+        return boundaries[i - 1] if i else -1
@@ -1,13 +1,43 @@
 import os
-from typing import Optional
+import copy
+import hashlib
+import queue
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Thread
+from typing import Iterator, List, Optional
 
 try:
-    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, StoppingCriteriaList
     import torch
     TRANSFORMERS_AVAILABLE = True
 except ImportError:
     TRANSFORMERS_AVAILABLE = False
 
+# Optional low-bit weight quantization (requires a CUDA GPU)
+try:
+    from transformers import BitsAndBytesConfig
+    import bitsandbytes
+    BITSANDBYTES_AVAILABLE = True
+except ImportError:
+    BITSANDBYTES_AVAILABLE = False
+
+# Optional Intel Extension for PyTorch: fused attention/linear kernels and BF16 GEMMs on Xeon/Core CPUs
+try:
+    import intel_extension_for_pytorch as ipex
+    IPEX_AVAILABLE = True
+except ImportError:
+    IPEX_AVAILABLE = False
+
+# Weight precisions selectable per model; "fp16" loads unquantized weights in the device's native dtype
+QUANTIZATION_OPTIONS = {
+    "fp16": "Unquantized (FP16 on GPU, BF16/FP32 on CPU)",
+    "int8": "INT8 (bitsandbytes)",
+    "int4": "INT4 NF4 (bitsandbytes)"
+}
+
 # Import web search capability
 try:
     from perplexity_search import PerplexitySearch
@@ -15,10 +45,135 @@ try:
 except ImportError:
     PERPLEXITY_AVAILABLE = False
 
+def _keyword_pattern(*keywords: str) -> re.Pattern:
+    """Compile substring keywords into one alternation, so a single regex scan replaces any(k in text ...)."""
+    return re.compile("|".join(map(re.escape, keywords)))
+
+# Keyword sets used to route questions; matched as substrings of the lowercased input like before
+REAL_TIME_PATTERN = _keyword_pattern('latest', 'recent', 'current', 'news', 'today', 'now', 'update', 'breaking', '2024', '2025', 'weather', 'forecast', 'happened', 'developments')
+KNOWLEDGE_QUESTION_PATTERN = _keyword_pattern('what is', 'what are', 'how does', 'how do', 'explain', 'tell me about', 'describe')
+EXPLAIN_PATTERN = _keyword_pattern('explain', 'what is', 'how does')
+DESCRIBE_PATTERN = _keyword_pattern('what', 'explain', 'describe', 'tell me about')
+HOW_WHY_PATTERN = _keyword_pattern('how', 'why', 'when', 'where')
+GREETING_PATTERN = _keyword_pattern('hello', 'hi', 'hey')
+QUESTION_WORD_PATTERN = _keyword_pattern('what', 'how', 'explain')
+HELP_PATTERN = _keyword_pattern('help', 'what can you do')
+THANKS_PATTERN = _keyword_pattern('thank', 'thanks')
+WHY_PATTERN = _keyword_pattern('why', 'because')
+WHEN_WHERE_PATTERN = _keyword_pattern('when', 'where')
+TECHNOLOGY_PATTERN = _keyword_pattern('technology', 'computer', 'software')
+SCIENCE_PATTERN = _keyword_pattern('science', 'research', 'study')
+BUSINESS_PATTERN = _keyword_pattern('business', 'company', 'market')
+
+# Case-sensitive markers looked for in retrieved context
+DOCUMENT_INDICATOR_PATTERN = _keyword_pattern("From ", "documents", "uploaded", "file")
+KNOWLEDGE_MARKER_PATTERN = _keyword_pattern("**Machine Learning", "**Software Development", "**Climate Change", "**Renewable Energy", "**Data Science", "**Business &", "**Health &", "**Education &")
+GENERATED_CONTEXT_PATTERN = _keyword_pattern("**Machine Learning", "**Software Development", "Previous topic:")
+
+@lru_cache(maxsize=1)
+def _get_integrator():
+    """The shared WebSearchIntegrator, imported on first use instead of rebuilt per response."""
+    from web_search_integration import web_search_integrator
+    return web_search_integrator
+
+# The model starting the next user turn marks the end of its reply
+STOP_SEQUENCE = "\nUser:"
+
+# Longest wait in seconds for the next streamed chunk before the stream gives up on generation
+STREAM_TIMEOUT = float(os.getenv('STREAM_TIMEOUT', '120'))
+
+# Keep the generation KV cache in host memory on GPU hosts, trading transfer time for longer contexts
+KV_CACHE_OFFLOAD = os.getenv('KV_CACHE_OFFLOAD', '0') == '1'
+
+# Rough characters per token, used to size budgets and when no tokenizer is loaded
+CHARS_PER_TOKEN = 4
+
+# Upper bound on the memory held by prompt-prefix KV caches kept between turns
+PREFIX_CACHE_BYTE_BUDGET = 1024 * 1024 * 1024
+
+# System instruction with examples, shared by every prompt
+SYSTEM_PROMPT = """You are Ogelo, an intelligent AI assistant with access to documents and knowledge bases. Provide comprehensive, helpful responses by:
+
+1. Using information from provided documents (always cite sources)
+2. Adding relevant general knowledge and examples with references
+3. Maintaining conversation context
+4. Being factual and acknowledging uncertainty
+5. Always including source citations and references for every answer
+
+Example responses with proper citations:
+
+User: What is renewable energy?
+Assistant: Renewable energy comes from natural sources that replenish themselves, like sunlight, wind, and water. For example, solar panels convert sunlight into electricity, while wind turbines harness moving air. The main types include:
+- Solar (photovoltaic panels and thermal)
+- Wind (onshore and offshore turbines)  
+- Hydroelectric (dams and run-of-river)
+- Geothermal (earth's heat)
+- Biomass (organic materials)
+
+These sources are sustainable because they naturally regenerate, unlike fossil fuels which take millions of years to form.
+
+**References:** Environmental science knowledge base, energy industry standards
+
+User: How does machine learning work?
+Assistant: Machine learning enables computers to learn patterns from data without explicit programming. Think of it like teaching a child to recognize cats - instead of listing every cat feature, you show many cat photos until they learn the pattern.
+
+The process involves:
+1. Training: Feed the algorithm labeled examples
+2. Learning: The system identifies patterns in the data
+3. Prediction: Apply learned patterns to new, unseen data
+
+For instance, email spam filters learn by analyzing thousands of emails marked as spam or legitimate, then use these patterns to classify new emails automatically.
+
+**References:** Computer science fundamentals, machine learning textbooks, practical AI applications"""
+
+def _cpu_supports_bf16() -> bool:
+    """Whether the CPU has AVX512-BF16 or AMX, so BF16 matmuls run natively instead of being emulated."""
+    for probe in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        check = getattr(torch.cpu, probe, None)
+        try:
+            if check is not None and check():
+                return True
+        except Exception:
+            pass
+    return False
+
+@lru_cache(maxsize=1)
+def _configure_torch_threads():
+    """Size torch's CPU thread pools once per process.
+    
+    Intra-op threads are capped at the cores this process may run on (containers often
+    expose fewer than the host has); TORCH_NUM_THREADS overrides. Decoding is one
+    sequential chain of ops, so the inter-op pool gets a single thread.
+    """
+    usable_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    num_threads = int(os.getenv('TORCH_NUM_THREADS', '0')) or min(torch.get_num_threads(), usable_cores or 1)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only settable before the first parallel op
+        pass
+
+class _StopOnText:
+    """Stopping criterion for generate(): stop each sequence once its generated text contains stop_text."""
+    
+    def __init__(self, tokenizer, stop_text: str, prompt_length: int, lookback: int = 8):
+        self.tokenizer = tokenizer
+        self.stop_text = stop_text
+        self.prompt_length = prompt_length
+        self.lookback = lookback
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        # Only the last few generated tokens are decoded; the prompt itself contains stop_text
+        start = max(self.prompt_length, input_ids.shape[1] - self.lookback)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        return torch.tensor([self.stop_text in tail for tail in tails], dtype=torch.bool, device=input_ids.device)
+
 class ModelHandler:
-    def __init__(self, model_name: str = "microsoft/Phi-3-mini-4k-instruct"):
-        """Initialize the model handler with a quantized LLM."""
+    def __init__(self, model_name: str = "microsoft/Phi-3-mini-4k-instruct", sampling: str = "greedy"):
+        """Initialize the model handler with a quantized LLM; sampling is "greedy" or "sample"."""
         self.model_name = model_name
+        self.sampling = sampling
         self.tokenizer = None
         self.model = None
         self.max_length = 2048
@@ -32,25 +187,34 @@ class ModelHandler:
             "microsoft/Phi-3-mini-4k-instruct": {
                 "name": "Phi-3 Mini (Recommended)",
                 "description": "Microsoft's efficient 4K context model, optimized for CPU",
-                "max_length": 4096
+                "max_length": 4096,
+                "quant": "int4"
             },
             "microsoft/DialoGPT-medium": {
                 "name": "DialoGPT Medium",
                 "description": "Conversational AI model, good for dialogue",
-                "max_length": 1024
+                "max_length": 1024,
+                "quant": "fp16"
             }
         }
+        self.quant = self.available_models.get(model_name, {}).get("quant", "fp16")
+        
+        # KV caches of previously seen prompt prefixes, keyed by a hash of their token ids
+        self._prefix_cache = OrderedDict()
+        self._prefix_cache_lock = threading.Lock()
+        self._system_prompt_length = None
         self.load_model()
     
     def get_available_models(self):
         """Get list of available models with descriptions."""
         return self.available_models
     
-    def switch_model(self, new_model_name: str):
-        """Switch to a different model."""
+    def switch_model(self, new_model_name: str, quant: str = None):
+        """Switch to a different model, optionally overriding its default weight precision."""
         if new_model_name in self.available_models:
             self.model_name = new_model_name
             self.max_length = self.available_models[new_model_name]["max_length"]
+            self.quant = quant or self.available_models[new_model_name].get("quant", "fp16")
             self.load_model()
             return True
         return False
@@ -63,12 +227,16 @@ class ModelHandler:
             self.tokenizer = "simple"
             return
             
+        self._clear_prefix_cache()
+        _configure_torch_threads()
+        
         try:
             print(f"Loading model: {self.model_name}")
             
             # Load tokenizer
             self.tokenizer = AutoTokenizer.from_pretrained(
                 self.model_name,
+                use_fast=True,
                 trust_remote_code=True
             )
             
@@ -76,16 +244,40 @@ class ModelHandler:
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
             
-            # Load model with CPU optimization
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float32,  # Use float32 for CPU
-                device_map="cpu",
-                trust_remote_code=True,
-                low_cpu_mem_usage=True
-            )
+            model_kwargs = dict(trust_remote_code=True, low_cpu_mem_usage=True)
+            checkpoint_quant = self._checkpoint_quantization()
+            quantization_config = None if checkpoint_quant else self._quantization_config()
+            if checkpoint_quant:
+                # Pre-quantized GPTQ/AWQ int4 weights load with their own kernels, CPU included
+                model_kwargs.update(device_map="auto")
+            elif quantization_config is not None:
+                # Low-bit weights cut memory bandwidth, the bottleneck during decoding
+                model_kwargs.update(quantization_config=quantization_config, device_map="auto")
+            elif torch.cuda.is_available():
+                model_kwargs.update(torch_dtype=torch.float16, device_map="auto")
+            else:
+                # Load model with CPU optimization: BF16 where IPEX can use native BF16 instructions, else float32
+                cpu_dtype = torch.bfloat16 if IPEX_AVAILABLE and _cpu_supports_bf16() else torch.float32
+                model_kwargs.update(torch_dtype=cpu_dtype, device_map="cpu")
+            
+            try:
+                # Fused scaled-dot-product attention instead of the eager matmul/softmax chain
+                self.model = AutoModelForCausalLM.from_pretrained(self.model_name, attn_implementation="sdpa", **model_kwargs)
+            except ValueError as e:
+                print(f"SDPA attention unavailable, using default attention: {e}")
+                self.model = AutoModelForCausalLM.from_pretrained(self.model_name, **model_kwargs)
+            self._optimize_for_cpu()
+            
+            if checkpoint_quant:
+                precision = f"{checkpoint_quant.upper()} checkpoint"
+            elif quantization_config is not None:
+                precision = QUANTIZATION_OPTIONS[self.quant]
+            else:
+                precision = f"unquantized {str(self.model.dtype).replace('torch.', '')}"
+            print(f"Model loaded successfully! ({precision})")
             
-            print("Model loaded successfully!")
+            self._prefill_system_prompt()
+            self._compile_model()
             
         except Exception as e:
             print(f"Error loading model: {e}")
@@ -93,26 +285,86 @@ class ModelHandler:
             self.model = "simple"
             self.tokenizer = "simple"
     
+    def _optimize_for_cpu(self):
+        """Swap in IPEX's optimized decoder kernels on CPU hosts; GPU and quantized models are left as loaded."""
+        if not IPEX_AVAILABLE or self.model.device.type != "cpu" or getattr(self.model.config, "quantization_config", None):
+            return
+        
+        try:
+            self.model = ipex.llm.optimize(self.model.eval(), dtype=self.model.dtype, inplace=True)
+            print(f"Applied Intel Extension for PyTorch optimizations ({self.model.dtype})")
+        except Exception as e:
+            print(f"IPEX optimization unavailable, using stock PyTorch: {e}")
+    
+    def _prefill_system_prompt(self):
+        """Compute the system prompt's KV cache at load time so even the first turn skips that prefill."""
+        self._cached_prefix_kwargs(self._tokenize_prompt(SYSTEM_PROMPT), [SYSTEM_PROMPT])
+    
+    def _compile_model(self):
+        """Compile the forward pass on GPU hosts and warm it up before the model is used.
+        
+        CPU-only installs, or any failure to compile, keep the eager model.
+        """
+        if not (hasattr(torch, "compile") and torch.cuda.is_available()):
+            return
+        
+        eager_forward = self.model.forward
+        try:
+            # Compile forward rather than the module so generate() and .device keep working.
+            # Default mode, not CUDA graphs: the growing DynamicCache changes shapes every
+            # decode step, which "reduce-overhead" would keep re-recording.
+            self.model.forward = torch.compile(eager_forward, mode="default", fullgraph=False, dynamic=True)
+            
+            # Pay the compile cost while loading, not concurrently with the first requests
+            inputs = self.tokenizer("Hello", return_tensors="pt").to(self.model.device)
+            with torch.no_grad():
+                self.model.generate(**inputs, max_new_tokens=4, pad_token_id=self.tokenizer.pad_token_id)
+            print("Compiled model warmed up")
+        except Exception as e:
+            print(f"torch.compile unavailable, using eager model: {e}")
+            self.model.forward = eager_forward
+    
+    def _checkpoint_quantization(self) -> Optional[str]:
+        """Quantization method baked into the checkpoint (e.g. "gptq", "awq"), or None for full-precision weights."""
+        try:
+            config = AutoConfig.from_pretrained(self.model_name, trust_remote_code=True)
+        except Exception:
+            return None
+        quantization_config = getattr(config, "quantization_config", None)
+        if not isinstance(quantization_config, dict):
+            return None
+        return str(quantization_config.get("quant_method", "quantized"))
+    
+    def _quantization_config(self):
+        """Build a bitsandbytes config for the selected precision, or None for unquantized weights."""
+        if self.quant not in ("int8", "int4"):
+            return None
+        
+        if not (BITSANDBYTES_AVAILABLE and torch.cuda.is_available()):
+            print(f"{self.quant.upper()} quantization requires bitsandbytes and a CUDA GPU - loading unquantized weights")
+            # Report what is actually loaded rather than the precision that was asked for
+            self.quant = "fp16"
+            return None
+        
+        if self.quant == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True)
+        
+        compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=compute_dtype
+        )
+    
     def generate_response(self, user_input: str, context: str = None, conversation_history: list = None) -> str:
         """Generate a response using advanced prompt engineering and context integration."""
         if self.model is None or self.tokenizer is None:
             return "Sorry, the model is not available. Please try again later."
         
         # Try web search for ALL questions to get comprehensive, current information
-        if self.web_search and self.web_search.is_available():
-            web_answer, web_sources = self.web_search.enhanced_search(user_input, context)
-            if web_answer and len(web_answer) > 100 and "Web search" not in web_answer and "failed" not in web_answer.lower():
-                # Format with web sources
-                if web_sources:
-                    web_answer += f"\n\n**Sources:**\n"
-                    for i, source in enumerate(web_sources[:5], 1):
-                        web_answer += f"{i}. {source}\n"
-                
-                # Add document context if available
-                if context and len(context) > 50 and not any(marker in context for marker in ["**Machine Learning", "**Software Development", "Previous topic:"]):
-                    web_answer += f"\n\n**Additional Context from Your Documents:**\n{context[:500]}..."
-                
-                return web_answer
+        web_answer = self._web_search_answer(user_input, context)
+        if web_answer:
+            return web_answer
         
         # Enhanced rule-based responses if no ML model is available
         if self.model == "simple":
@@ -122,31 +374,18 @@ class ModelHandler:
             # Build enhanced prompt with examples and context
             prompt = self._build_enhanced_prompt(user_input, context, conversation_history)
             
-            # Tokenize input
-            inputs = self.tokenizer.encode(
-                prompt,
-                return_tensors="pt",
-                max_length=self.max_length - 300,  # Leave room for generation
-                truncation=True
-            )
+            # Tokenize input and reuse cached KV state for any previously seen prefix
+            inputs = self._tokenize_prompt(prompt)
+            generation_kwargs = self._generation_kwargs(inputs.shape[1])
+            generation_kwargs.update(self._cached_prefix_kwargs(inputs, self._prompt_prefixes()))
             
             # Generate response
             with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs,
-                    max_new_tokens=250,
-                    temperature=0.7,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    repetition_penalty=1.1
-                )
-            
-            # Decode response
-            full_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
-            # Extract only the new generated part
-            response = full_response[len(prompt):].strip()
+                outputs = self.model.generate(inputs, attention_mask=torch.ones_like(inputs), **generation_kwargs)
+            new_tokens = outputs[0, inputs.shape[1]:]
+            
+            # Decode only the generated tokens, up to any turn the model started for the user
+            response = self.tokenizer.decode(new_tokens, skip_special_tokens=True).split(STOP_SEQUENCE)[0].strip()
             
             # Clean up response
             if not response:
@@ -161,44 +400,284 @@ class ModelHandler:
             print(f"Error generating response: {e}")
             return self._enhanced_simple_response(user_input, context, conversation_history)
     
+    def generate_response_stream(self, user_input: str, context: str = None, conversation_history: list = None) -> Iterator[str]:
+        """Yield the response incrementally as the model decodes it.
+        
+        Web search and rule-based answers are produced in one piece and yielded as a single chunk.
+        """
+        if self.model is None or self.tokenizer is None:
+            yield "Sorry, the model is not available. Please try again later."
+            return
+        
+        web_answer = self._web_search_answer(user_input, context)
+        if web_answer:
+            yield web_answer
+            return
+        
+        if self.model == "simple":
+            yield self._enhanced_simple_response(user_input, context, conversation_history)
+            return
+        
+        streamed_parts = []
+        try:
+            prompt = self._build_enhanced_prompt(user_input, context, conversation_history)
+            inputs = self._tokenize_prompt(prompt)
+            
+            # Run generation in the background and read decoded text as it is produced
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT)
+            generation_kwargs = self._generation_kwargs(inputs.shape[1])
+            generation_kwargs.update(self._cached_prefix_kwargs(inputs, self._prompt_prefixes()))
+            generation_kwargs.update(inputs=inputs, attention_mask=torch.ones_like(inputs), streamer=streamer)
+            generation_errors = []
+            
+            def generate():
+                # An exception here would otherwise leave the streamer waiting for text that never comes
+                try:
+                    self.model.generate(**generation_kwargs)
+                except Exception as e:
+                    generation_errors.append(e)
+                    streamer.end()
+            
+            thread = Thread(target=generate, daemon=True)
+            thread.start()
+            
+            for text in streamer:
+                if not text:
+                    continue
+                # Withhold the start of a user turn; generation stops right after it
+                streamed = "".join(streamed_parts)
+                stop = (streamed + text).find(STOP_SEQUENCE)
+                if stop >= 0:
+                    text = (streamed + text)[len(streamed):stop]
+                streamed_parts.append(text)
+                if text:
+                    yield text
+                if stop >= 0:
+                    break
+            thread.join()
+            if generation_errors:
+                raise generation_errors[0]
+            
+            response = "".join(streamed_parts).strip()
+            if not response:
+                yield "I understand your question, but I'm having trouble generating a response right now. Could you please rephrase your question?"
+                return
+            
+            # Stream any knowledge enhancement as a trailing chunk
+            enhanced = self._enhance_response_with_knowledge(response, user_input)
+            if len(enhanced) > len(response):
+                yield enhanced[len(response):]
+                
+        except queue.Empty:
+            print(f"Error streaming response: no output from the model for {STREAM_TIMEOUT:.0f}s")
+            if not streamed_parts:
+                yield self._enhanced_simple_response(user_input, context, conversation_history)
+        except Exception as e:
+            print(f"Error streaming response: {e}")
+            if not streamed_parts:
+                yield self._enhanced_simple_response(user_input, context, conversation_history)
+    
+    def trim_history(self, messages: list, max_turns: int = 8, max_tokens: int = 2048) -> list:
+        """Return the most recent non-error turns that fit the token budget, without UI-only fields."""
+        turns = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in messages
+            if msg.get("role") in ("user", "assistant")
+            and not msg.get("content", "").startswith("Sorry, I encountered an error")
+        ][-2 * max_turns:]
+        
+        # Keep the newest messages until the token budget is spent
+        kept = []
+        used_tokens = 0
+        for msg in reversed(turns):
+            used_tokens += self._count_tokens(msg["content"])
+            if used_tokens > max_tokens:
+                break
+            kept.append(msg)
+        return kept[::-1]
+    
+    def _count_tokens(self, text: str) -> int:
+        """Count tokens with the loaded tokenizer, or estimate ~4 characters per token without one."""
+        if self.tokenizer is None or self.tokenizer == "simple":
+            return len(text) // CHARS_PER_TOKEN + 1
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+    
+    def _truncate_to_tokens(self, text: str, max_tokens: int) -> str:
+        """Cut text to at most max_tokens tokens, on a token boundary; by characters without a tokenizer."""
+        if self.tokenizer is None or self.tokenizer == "simple":
+            return text[:max_tokens * CHARS_PER_TOKEN]
+        ids = self.tokenizer(text, add_special_tokens=False).input_ids
+        if len(ids) <= max_tokens:
+            return text
+        return self.tokenizer.decode(ids[:max_tokens])
+    
+    def _web_search_answer(self, user_input: str, context: str = None) -> Optional[str]:
+        """Return a formatted web search answer, or None if web search gave nothing usable."""
+        if not (self.web_search and self.web_search.is_available()):
+            return None
+        
+        web_answer, web_sources = self.web_search.enhanced_search(user_input, context)
+        if web_answer and len(web_answer) > 100 and "Web search" not in web_answer and "failed" not in web_answer.lower():
+            # Format with web sources
+            web_answer = self._format_sources(web_answer, web_sources, "Sources", limit=5)
+            
+            # Add document context if available
+            if context and len(context) > 50 and not GENERATED_CONTEXT_PATTERN.search(context):
+                web_answer += f"\n\n**Additional Context from Your Documents:**\n{self._truncate_to_tokens(context, 500 // CHARS_PER_TOKEN)}..."
+            
+            return web_answer
+        return None
+    
+    @staticmethod
+    def _format_sources(answer: str, sources: list, heading: str = "Web Sources", limit: int = 3) -> str:
+        """Append a numbered list of the first few sources under a bold heading."""
+        if not sources:
+            return answer
+        listed = "".join(f"{i}. {source}\n" for i, source in enumerate(sources[:limit], 1))
+        return f"{answer}\n\n**{heading}:**\n{listed}"
+    
+    def _tokenize_prompt(self, prompt: str):
+        """Tokenize a prompt, leaving room in the context window for generation."""
+        return self.tokenizer(
+            prompt,
+            return_tensors="pt",
+            max_length=self.max_length - 300,  # Leave room for generation
+            truncation=True
+        ).input_ids.to(self.model.device)
+    
+    def _prompt_prefixes(self) -> List[str]:
+        """Prompt prefixes worth caching: only the system prompt, which every turn shares.
+        
+        The system-plus-history boundary changes with every turn, so its KV state would
+        never be reused, only prefilled, copied and held in memory.
+        """
+        return [SYSTEM_PROMPT]
+    
+    def _prefix_key(self, ids) -> bytes:
+        """Hash a 1-D tensor of token ids."""
+        return hashlib.blake2b(ids.cpu().numpy().tobytes(), digest_size=16).digest()
+    
+    def _cached_prefix_kwargs(self, inputs, prefixes: List[str]) -> dict:
+        """Return generate() kwargs carrying the KV cache of the longest cached prefix of inputs.
+        
+        Prefix boundaries beyond the longest hit are prefilled incrementally and cached,
+        so following turns only prefill the tokens after them.
+        """
+        if self._offload_kv_cache():
+            # Prefix caches would pin KV state in GPU memory, which offloading is meant to free
+            return {}
+        
+        ids = inputs[0]
+        best, best_len = None, 0
+        try:
+            with self._prefix_cache_lock:
+                # Longest cached prefix of this prompt, if any
+                for key, (prefix_len, cache) in sorted(self._prefix_cache.items(), key=lambda item: -item[1][0]):
+                    if prefix_len < len(ids) and self._prefix_key(ids[:prefix_len]) == key:
+                        self._prefix_cache.move_to_end(key)
+                        best, best_len = cache, prefix_len
+                        break
+            
+            # Extend to any longer prefix boundary. The last prefix token may merge with
+            # the text that follows it, so each boundary stops one token early.
+            for prefix in prefixes:
+                prefix_len = self._prefix_token_length(prefix)
+                if prefix_len <= best_len or prefix_len >= len(ids):
+                    continue
+                past = copy.deepcopy(best) if best is not None else None
+                with torch.no_grad():
+                    outputs = self.model(
+                        input_ids=ids[best_len:prefix_len].unsqueeze(0),
+                        past_key_values=past,
+                        use_cache=True
+                    )
+                best, best_len = outputs.past_key_values, prefix_len
+                self._store_prefix_cache(self._prefix_key(ids[:prefix_len]), prefix_len, best)
+            
+            if best is not None:
+                # generate() appends to the cache in place, so hand it a copy
+                return {"past_key_values": copy.deepcopy(best)}
+        except Exception as e:
+            print(f"Prefix cache unavailable, prefilling full prompt: {e}")
+        return {}
+    
+    def _store_prefix_cache(self, key: bytes, prefix_len: int, cache):
+        """Insert a prefix KV cache, evicting least recently used entries beyond the memory budget."""
+        max_tokens = PREFIX_CACHE_BYTE_BUDGET // self._kv_bytes_per_token()
+        with self._prefix_cache_lock:
+            self._prefix_cache[key] = (prefix_len, cache)
+            self._prefix_cache.move_to_end(key)
+            while sum(length for length, _ in self._prefix_cache.values()) > max_tokens and len(self._prefix_cache) > 1:
+                self._prefix_cache.popitem(last=False)
+    
+    def _kv_bytes_per_token(self) -> int:
+        """Bytes of key and value state one token occupies across all layers of the loaded model."""
+        config = self.model.config
+        num_heads = config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        return 2 * config.num_hidden_layers * num_kv_heads * head_dim * torch.empty(0, dtype=self.model.dtype).element_size()
+    
+    def _prefix_token_length(self, prefix: str) -> int:
+        """Token count of a prompt prefix, less its last token; the fixed system prompt is tokenized only once."""
+        if prefix is SYSTEM_PROMPT:
+            if self._system_prompt_length is None:
+                self._system_prompt_length = len(self.tokenizer(SYSTEM_PROMPT).input_ids) - 1
+            return self._system_prompt_length
+        return len(self.tokenizer(prefix).input_ids) - 1
+    
+    def _clear_prefix_cache(self):
+        """Drop all cached prefix KV state, e.g. when the model changes."""
+        with self._prefix_cache_lock:
+            self._prefix_cache.clear()
+        self._system_prompt_length = None
+    
+    def _generation_kwargs(self, prompt_length: int) -> dict:
+        """Decoding settings shared by blocking and streaming generation.
+        
+        Greedy decoding skips the per-step softmax, sampling and repetition-penalty
+        passes over the vocabulary; sampling="sample" restores the previous settings.
+        """
+        generation_kwargs = dict(
+            max_new_tokens=250,
+            do_sample=False,
+            num_beams=1,
+            use_cache=True,
+            pad_token_id=self.tokenizer.pad_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            stopping_criteria=StoppingCriteriaList([_StopOnText(self.tokenizer, STOP_SEQUENCE, prompt_length)])
+        )
+        if self.sampling == "sample":
+            generation_kwargs.update(do_sample=True, temperature=0.7, repetition_penalty=1.1)
+        if self._offload_kv_cache():
+            # OffloadedCache keeps layers' KV on the CPU and prefetches one layer ahead onto the GPU
+            generation_kwargs.update(cache_implementation="offloaded")
+        return generation_kwargs
+    
+    def _offload_kv_cache(self) -> bool:
+        """Whether KV_CACHE_OFFLOAD is set and the model runs on a GPU; CPU models already keep KV in RAM."""
+        return KV_CACHE_OFFLOAD and self.model.device.type == "cuda"
+    
     def _build_enhanced_prompt(self, user_input: str, context: str = None, conversation_history: list = None) -> str:
         """Build an enhanced prompt with examples and structured context."""
+        prompt_parts = [self._build_prompt_prefix(conversation_history)]
+        
+        # Add document context if available
+        if context and context.strip():
+            prompt_parts.append(f"\nDocument information:\n{self._truncate_to_tokens(context, 800 // CHARS_PER_TOKEN)}")
+        
+        # Add the current question
+        prompt_parts.append(f"\nUser: {user_input}")
+        prompt_parts.append("Assistant:")
+        
+        return "\n".join(prompt_parts)
+    
+    def _build_prompt_prefix(self, conversation_history: list = None) -> str:
+        """Build the system instructions and recent conversation that lead every prompt."""
         prompt_parts = []
         
         # System instruction with examples
-        prompt_parts.append("""You are Ogelo, an intelligent AI assistant with access to documents and knowledge bases. Provide comprehensive, helpful responses by:
-
-1. Using information from provided documents (always cite sources)
-2. Adding relevant general knowledge and examples with references
-3. Maintaining conversation context
-4. Being factual and acknowledging uncertainty
-5. Always including source citations and references for every answer
-
-Example responses with proper citations:
-
-User: What is renewable energy?
-Assistant: Renewable energy comes from natural sources that replenish themselves, like sunlight, wind, and water. For example, solar panels convert sunlight into electricity, while wind turbines harness moving air. The main types include:
-- Solar (photovoltaic panels and thermal)
-- Wind (onshore and offshore turbines)  
-- Hydroelectric (dams and run-of-river)
-- Geothermal (earth's heat)
-- Biomass (organic materials)
-
-These sources are sustainable because they naturally regenerate, unlike fossil fuels which take millions of years to form.
-
-**References:** Environmental science knowledge base, energy industry standards
-
-User: How does machine learning work?
-Assistant: Machine learning enables computers to learn patterns from data without explicit programming. Think of it like teaching a child to recognize cats - instead of listing every cat feature, you show many cat photos until they learn the pattern.
-
-The process involves:
-1. Training: Feed the algorithm labeled examples
-2. Learning: The system identifies patterns in the data
-3. Prediction: Apply learned patterns to new, unseen data
-
-For instance, email spam filters learn by analyzing thousands of emails marked as spam or legitimate, then use these patterns to classify new emails automatically.
-
-**References:** Computer science fundamentals, machine learning textbooks, practical AI applications""")
+        prompt_parts.append(SYSTEM_PROMPT)
         
         # Add conversation history for context
         if conversation_history and len(conversation_history) > 0:
@@ -211,14 +690,6 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
                 elif role == 'assistant':
                     prompt_parts.append(f"Assistant: {content}")
         
-        # Add document context if available
-        if context and context.strip():
-            prompt_parts.append(f"\nDocument information:\n{context[:800]}")
-        
-        # Add the current question
-        prompt_parts.append(f"\nUser: {user_input}")
-        prompt_parts.append("Assistant:")
-        
         return "\n".join(prompt_parts)
     
     def _enhance_response_with_knowledge(self, response: str, user_input: str) -> str:
@@ -226,7 +697,7 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
         user_lower = user_input.lower()
         
         # Add examples for certain topics
-        if any(term in user_lower for term in ['explain', 'what is', 'how does']):
+        if EXPLAIN_PATTERN.search(user_lower):
             if len(response) < 100:  # Short response, add more context
                 if 'example' not in response.lower():
                     response += "\n\nFor example, " + self._get_contextual_example(user_input)
@@ -237,11 +708,11 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
         """Get a contextual example based on the user's question."""
         user_lower = user_input.lower()
         
-        if any(word in user_lower for word in ['technology', 'computer', 'software']):
+        if TECHNOLOGY_PATTERN.search(user_lower):
             return "in software development, this principle is often applied in creating user interfaces that adapt to user behavior."
-        elif any(word in user_lower for word in ['science', 'research', 'study']):
+        elif SCIENCE_PATTERN.search(user_lower):
             return "researchers often use this approach to validate their hypotheses through controlled experiments."
-        elif any(word in user_lower for word in ['business', 'company', 'market']):
+        elif BUSINESS_PATTERN.search(user_lower):
             return "companies like Amazon and Google have successfully implemented similar strategies to improve customer experience."
         else:
             return "this concept applies to many real-world situations where understanding patterns and relationships is important."
@@ -253,23 +724,21 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
         # Enhanced context-aware responses that directly answer questions
         if context and context.strip():
             # Check if context contains useful document information (not just conversation history)
-            has_document_info = any(indicator in context for indicator in ["From ", "documents", "uploaded", "file"])
+            has_document_info = DOCUMENT_INDICATOR_PATTERN.search(context) is not None
             has_conversation_only = "Previous topic:" in context and not has_document_info
             
             # If context is just old conversations, ignore it and provide knowledge response
             if has_conversation_only or len(context) < 100:
-                from web_search_integration import WebSearchIntegrator
-                integrator = WebSearchIntegrator()
+                integrator = _get_integrator()
                 enhanced_context = integrator._enhance_with_knowledge(user_input)
                 if enhanced_context and len(enhanced_context) > 100:
                     return enhanced_context
             
             # Extract knowledge from context to provide direct answers
-            from web_search_integration import WebSearchIntegrator
-            integrator = WebSearchIntegrator()
+            integrator = _get_integrator()
             
             # If context already contains enhanced knowledge, use it directly  
-            if any(marker in context for marker in ["**Machine Learning", "**Software Development", "**Climate Change", "**Renewable Energy", "**Data Science", "**Business &", "**Health &", "**Education &"]):
+            if KNOWLEDGE_MARKER_PATTERN.search(context):
                 return context
             
             # Otherwise, enhance the context and provide a direct answer
@@ -278,9 +747,9 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
                 return enhanced_context
             
             # Fallback to basic context processing
-            context_snippet = context[:500]
+            context_snippet = self._truncate_to_tokens(context, 500 // CHARS_PER_TOKEN)
             
-            if any(word in user_lower for word in ['what', 'explain', 'describe', 'tell me about']):
+            if DESCRIBE_PATTERN.search(user_lower):
                 response = f"Based on available information: {context_snippet}"
                 
                 # Add knowledge enhancement
@@ -290,7 +759,7 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
                 
                 return response
                 
-            elif any(word in user_lower for word in ['how', 'why', 'when', 'where']):
+            elif HOW_WHY_PATTERN.search(user_lower):
                 response = f"**Answer:** {context_snippet}"
                 
                 # Add practical guidance
@@ -301,46 +770,36 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
                 return response
         
         # Check for real-time information needs first
-        real_time_indicators = ['latest', 'recent', 'current', 'news', 'today', 'now', 'update', 'breaking', '2024', '2025', 'weather', 'forecast', 'happened', 'developments']
-        needs_real_time = any(indicator in user_lower for indicator in real_time_indicators)
+        needs_real_time = REAL_TIME_PATTERN.search(user_lower) is not None
         
         # Try web search first for real-time questions
         if needs_real_time and self.web_search and self.web_search.is_available():
             web_answer, web_sources = self.web_search.enhanced_search(user_input, context)
             if web_answer and len(web_answer) > 100:
                 # Format with web sources
-                if web_sources:
-                    web_answer += f"\n\n**Web Sources:**\n"
-                    for i, source in enumerate(web_sources[:3], 1):
-                        web_answer += f"{i}. {source}\n"
-                return web_answer
+                return self._format_sources(web_answer, web_sources)
         
         # Check for knowledge questions (after real-time check)
-        if any(word in user_lower for word in ['what is', 'what are', 'how does', 'how do', 'explain', 'tell me about', 'describe']):
+        if KNOWLEDGE_QUESTION_PATTERN.search(user_lower):
             # Try web search first for real-time information
             if self.web_search and self.web_search.is_available():
                 web_answer, web_sources = self.web_search.enhanced_search(user_input, context)
                 if web_answer and len(web_answer) > 100:
                     # Format with web sources
-                    if web_sources:
-                        web_answer += f"\n\n**Web Sources:**\n"
-                        for i, source in enumerate(web_sources[:3], 1):
-                            web_answer += f"{i}. {source}\n"
-                    return web_answer
+                    return self._format_sources(web_answer, web_sources)
             
             # Fallback to internal knowledge
-            from web_search_integration import WebSearchIntegrator
-            integrator = WebSearchIntegrator()
+            integrator = _get_integrator()
             enhanced_context = integrator._enhance_with_knowledge(user_input)
             
             if enhanced_context and len(enhanced_context) > 100:
                 return enhanced_context
         
         # Enhanced general responses with examples and context  
-        if any(word in user_lower for word in ['hello', 'hi', 'hey']) and not any(word in user_lower for word in ['what', 'how', 'explain']):
+        if GREETING_PATTERN.search(user_lower) and not QUESTION_WORD_PATTERN.search(user_lower):
             return "Hello! I'm Ogelo, your intelligent RAG assistant. I can provide comprehensive answers by combining information from your documents with my extensive knowledge base. I can analyze PDFs, text files, CSV data, images (OCR), and web content. What would you like to explore today?"
         
-        elif any(word in user_lower for word in ['help', 'what can you do']):
+        elif HELP_PATTERN.search(user_lower):
             return """I provide intelligent responses by combining multiple sources with proper citations:
 
 📚 **Document Analysis**: Search through your uploaded files (PDF, text, CSV, images, web content)
@@ -358,7 +817,7 @@ For instance, email spam filters learn by analyzing thousands of emails marked a
 
 Try asking questions about your documents, or ask me to explain complex topics with proper citations!"""
         
-        elif any(word in user_lower for word in ['thank', 'thanks']):
+        elif THANKS_PATTERN.search(user_lower):
             return "You're welcome! I'm here to provide comprehensive answers by combining your documents with broader knowledge and examples. Feel free to ask follow-up questions or explore new topics!"
         
         else:
@@ -366,15 +825,11 @@ Try asking questions about your documents, or ask me to explain complex topics w
             if self.web_search and self.web_search.is_available():
                 web_answer, web_sources = self.web_search.enhanced_search(user_input, context)
                 if web_answer and len(web_answer) > 50:
-                    if web_sources:
-                        web_answer += f"\n\n**Web Sources:**\n"
-                        for i, source in enumerate(web_sources[:3], 1):
-                            web_answer += f"{i}. {source}\n"
-                    return web_answer
+                    return self._format_sources(web_answer, web_sources)
             
             # Intelligent fallback with knowledge integration and citations
             if context:
-                response = f"**From Your Documents:** {context[:300]}..."
+                response = f"**From Your Documents:** {self._truncate_to_tokens(context, 300 // CHARS_PER_TOKEN)}..."
                 response += "\n\n**Knowledge Integration:** Combining this with my knowledge base, I can provide additional context and examples to help answer your question comprehensively."
                 response += "\n\n**References:**"
                 response += "\n- Your uploaded documents"
@@ -384,8 +839,7 @@ Try asking questions about your documents, or ask me to explain complex topics w
                 return response
             else:
                 # Get enhanced knowledge from web search integration
-                from web_search_integration import WebSearchIntegrator
-                integrator = WebSearchIntegrator()
+                integrator = _get_integrator()
                 enhanced_context = integrator._enhance_with_knowledge(user_input)
                 
                 if enhanced_context and len(enhanced_context) > 100:
@@ -396,11 +850,11 @@ Try asking questions about your documents, or ask me to explain complex topics w
                     response = f"**Knowledge-Based Response for: '{user_input}'**\n\n"
                     
                     # Add context based on question type
-                    if any(word in user_lower for word in ['how', 'explain', 'what']):
+                    if QUESTION_WORD_PATTERN.search(user_lower):
                         response += "I can provide a comprehensive explanation with examples and context from my knowledge base. "
-                    elif any(word in user_lower for word in ['why', 'because']):
+                    elif WHY_PATTERN.search(user_lower):
                         response += "I can explain the reasoning and provide background context from established knowledge. "
-                    elif any(word in user_lower for word in ['when', 'where']):
+                    elif WHEN_WHERE_PATTERN.search(user_lower):
                         response += "I can provide information about timing, location, and relevant circumstances from available knowledge. "
                     
                     response += "\n\n**Available Knowledge Sources:**"
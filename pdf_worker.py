@@ -0,0 +1,37 @@
+"""
+PDF page text extraction, importable on its own by worker processes.
+
+Kept out of document_processor so pool workers load only PyPDF2, not the database,
+embedding and model stack that document_processor imports.
+"""
+
+from typing import List, Optional, Tuple
+import PyPDF2
+
+def page_may_have_text(page) -> bool:
+    """Cheap look at the page dictionary: no content stream, or no fonts or forms to draw text with, means no text."""
+    if page.get('/Contents') is None:
+        return False
+    resources = page.get('/Resources')
+    if resources is None:
+        return True  # Let extract_text decide for unusual resource layouts
+    resources = resources.get_object()
+    return '/Font' in resources or '/XObject' in resources
+
+def extract_page_texts(pdf_reader, page_numbers: range) -> List[Tuple[int, Optional[str]]]:
+    """Return (page number, text) for the given pages; text is None for pages that fail."""
+    page_texts = []
+    for page_num in page_numbers:
+        try:
+            page = pdf_reader.pages[page_num]
+            # Blank and vector-only pages skip decoding their content streams
+            page_texts.append((page_num, page.extract_text() if page_may_have_text(page) else ""))
+        except Exception as page_error:
+            print(f"Error extracting text from page {page_num + 1}: {page_error}")
+            page_texts.append((page_num, None))
+    return page_texts
+
+def extract_pdf_file_pages(path: str, page_numbers: range) -> List[Tuple[int, Optional[str]]]:
+    """Worker-process entry point: open the PDF at path and extract the given pages."""
+    with open(path, 'rb') as pdf_file:
+        return extract_page_texts(PyPDF2.PdfReader(pdf_file), page_numbers)
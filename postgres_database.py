@@ -1,7 +1,9 @@
 import os
+import threading
 import psycopg2
 import numpy as np
-import pickle
+from utils import chunk_hash, encode_embedding
+from vector_index import load_corpus_matrix, CorpusIndex
 from typing import List, Tuple, Optional
 import logging
 
@@ -11,6 +13,11 @@ class PostgreSQLManager:
         self.connection_string = os.getenv('DATABASE_URL')
         if not self.connection_string:
             raise Exception("PostgreSQL DATABASE_URL not found in environment variables")
+        
+        # In-process cache of the corpus index used by search_similar_chunks
+        self._corpus_lock = threading.Lock()
+        self._documents_version = 0
+        self._invalidate_corpus()
         self.init_database()
     
     def get_connection(self):
@@ -31,10 +38,18 @@ class PostgreSQLManager:
                     content TEXT NOT NULL,
                     chunk_index INTEGER NOT NULL,
                     embedding BYTEA NOT NULL,
+                    embedding_precision TEXT NOT NULL DEFAULT 'float32',
+                    embedding_scale REAL,
+                    chunk_hash BYTEA,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
             
+            # Older databases predate the precision/scale columns; float32 is what they stored
+            cursor.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS embedding_precision TEXT NOT NULL DEFAULT 'float32'")
+            cursor.execute('ALTER TABLE documents ADD COLUMN IF NOT EXISTS embedding_scale REAL')
+            cursor.execute('ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunk_hash BYTEA')
+            
             # Create conversations table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS conversations (
@@ -52,10 +67,24 @@ class PostgreSQLManager:
                 ON documents(filename)
             ''')
             
-            # Create index on created_at for faster conversation retrieval
+            # A chunk is stored once per file; identical text in another file reuses its embedding.
+            # Earlier databases made chunk_hash unique across all files, which dropped the second file's rows.
+            cursor.execute('DROP INDEX IF EXISTS idx_documents_hash')
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_documents_filename_hash 
+                ON documents(filename, chunk_hash)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_documents_chunk_hash 
+                ON documents(chunk_hash)
+            ''')
+            
+            # Create index on created_at for faster conversation retrieval; id breaks ties
+            # between rows written in one batch, which share a timestamp
+            cursor.execute('DROP INDEX IF EXISTS idx_conversations_created_at')
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_conversations_created_at 
-                ON conversations(created_at DESC)
+                CREATE INDEX IF NOT EXISTS idx_conversations_created_at_id 
+                ON conversations(created_at DESC, id DESC)
             ''')
             
             conn.commit()
@@ -72,54 +101,162 @@ class PostgreSQLManager:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            # Serialize embedding
-            embedding_blob = pickle.dumps(embedding)
+            # Serialize embedding (float32 by default, see EMBEDDING_PRECISION)
+            embedding_blob, precision, scale = encode_embedding(embedding)
             
             cursor.execute('''
-                INSERT INTO documents (filename, content, chunk_index, embedding)
-                VALUES (%s, %s, %s, %s)
-            ''', (filename, content, chunk_index, embedding_blob))
+                INSERT INTO documents (filename, content, chunk_index, embedding, embedding_precision, embedding_scale, chunk_hash)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT DO NOTHING
+            ''', (filename, content, chunk_index, embedding_blob, precision, scale, chunk_hash(content)))
             
             conn.commit()
             conn.close()
+            self._corpus_rows_added()
             return True
         except Exception as e:
             print(f"Error storing document chunk: {e}")
             return False
     
-    def search_similar_chunks(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[str, str, float]]:
-        """Search for similar document chunks using cosine similarity."""
+    def store_document_chunks_bulk(self, filename: str, chunks: List[str], embeddings: np.ndarray, chunk_indices: List[int] = None) -> bool:
+        """Store all chunks of a document in a single transaction; chunks already stored under filename are skipped."""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            cursor.execute('SELECT filename, content, embedding FROM documents')
-            results = cursor.fetchall()
+            if chunk_indices is None:
+                chunk_indices = range(len(chunks))
+            rows = [
+                (filename, chunk, chunk_index, *encode_embedding(embedding), chunk_hash(chunk))
+                for chunk, chunk_index, embedding in zip(chunks, chunk_indices, embeddings)
+            ]
+            
+            cursor.executemany('''
+                INSERT INTO documents (filename, content, chunk_index, embedding, embedding_precision, embedding_scale, chunk_hash)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT DO NOTHING
+            ''', rows)
+            
+            conn.commit()
             conn.close()
+            self._corpus_rows_added()
+            return True
+        except Exception as e:
+            print(f"Error storing document chunks: {e}")
+            return False
+    
+    def store_existing_chunks(self, filename: str, hashes: List[bytes], chunk_indices: List[int]) -> bool:
+        """Store rows for chunks whose text is already embedded, copying the stored embedding instead of recomputing it."""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.executemany('''
+                INSERT INTO documents (filename, content, chunk_index, embedding, embedding_precision, embedding_scale, chunk_hash)
+                SELECT %s, content, %s, embedding, embedding_precision, embedding_scale, chunk_hash
+                FROM documents WHERE chunk_hash = %s LIMIT 1
+                ON CONFLICT DO NOTHING
+            ''', [(filename, chunk_index, psycopg2.Binary(digest)) for digest, chunk_index in zip(hashes, chunk_indices)])
             
-            if not results:
+            conn.commit()
+            conn.close()
+            self._corpus_rows_added()
+            return True
+        except Exception as e:
+            print(f"Error storing existing chunks: {e}")
+            return False
+    
+    def get_existing_chunk_hashes(self, hashes: List[bytes]) -> set:
+        """Return the subset of chunk hashes that are already stored."""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT chunk_hash FROM documents WHERE chunk_hash = ANY(%s)',
+                ([psycopg2.Binary(h) for h in hashes],)
+            )
+            existing = {bytes(row[0]) for row in cursor.fetchall()}
+            conn.close()
+            return existing
+        except Exception as e:
+            print(f"Error looking up chunk hashes: {e}")
+            return set()
+    
+    def search_similar_chunks(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[str, str, float]]:
+        """Search for similar document chunks using cosine similarity."""
+        try:
+            hits = self._ensure_corpus().search(query_embedding, top_k)
+            if not hits:
                 return []
             
-            similarities = []
-            for filename, content, embedding_blob in results:
-                # Deserialize embedding
-                embedding = pickle.loads(embedding_blob)
-                
-                # Calculate cosine similarity
-                similarity = self._cosine_similarity(query_embedding, embedding)
-                similarities.append((filename, content, similarity))
+            # Only the winning rows' text is read; the cached corpus holds ids and vectors
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT id, filename, content FROM documents WHERE id = ANY(%s)',
+                ([row_id for row_id, _ in hits],)
+            )
+            rows = {row_id: (filename, content) for row_id, filename, content in cursor.fetchall()}
+            conn.close()
             
-            # Sort by similarity and return top_k
-            similarities.sort(key=lambda x: x[2], reverse=True)
-            return similarities[:top_k]
+            return [(*rows[row_id], score) for row_id, score in hits if row_id in rows]
             
         except Exception as e:
             print(f"Error searching similar chunks: {e}")
             return []
     
-    def _cosine_similarity(self, a: np.ndarray, b: np.ndarray) -> float:
-        """Calculate cosine similarity between two vectors."""
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+    def get_documents_version(self) -> int:
+        """Return a counter that changes whenever the documents table is modified."""
+        return self._documents_version
+    
+    def _invalidate_corpus(self):
+        """Mark the cached corpus index stale after rows are removed; the index is rebuilt."""
+        with self._corpus_lock:
+            self._corpus = None
+            self._dirty = True
+            self._rows_added = False
+            self._documents_version += 1
+    
+    def _corpus_rows_added(self):
+        """Note an insert; the cached index only picks up the new rows."""
+        with self._corpus_lock:
+            self._rows_added = True
+            self._documents_version += 1
+    
+    def _ensure_corpus(self) -> CorpusIndex:
+        """Return the cached corpus index, reloading it after deletes and extending it after inserts."""
+        with self._corpus_lock:
+            if self._dirty:
+                conn = self.get_connection()
+                cursor = conn.cursor()
+                
+                cursor.execute('SELECT COUNT(*) FROM documents')
+                n_rows = cursor.fetchone()[0]
+                
+                # A named (server-side) cursor streams rows instead of buffering the whole table
+                stream = conn.cursor(name='corpus_matrix')
+                stream.execute('SELECT id, embedding, embedding_precision, embedding_scale FROM documents ORDER BY id')
+                self._corpus = CorpusIndex(*load_corpus_matrix(stream, n_rows))
+                stream.close()
+                conn.close()
+                
+                self._dirty = False
+                self._rows_added = False
+            elif self._rows_added:
+                # New rows are the ones past the highest cached SERIAL id
+                conn = self.get_connection()
+                cursor = conn.cursor()
+                cursor.execute(
+                    'SELECT id, embedding, embedding_precision, embedding_scale FROM documents WHERE id > %s ORDER BY id',
+                    (int(self._corpus.ids.max(initial=0)),)
+                )
+                self._corpus.extend(*load_corpus_matrix(cursor, 0))
+                conn.close()
+                
+                self._rows_added = False
+            
+            return self._corpus
     
     def store_conversation(self, user_message: str, assistant_response: str, context_used: str = None) -> bool:
         """Store a conversation exchange."""
@@ -139,6 +276,24 @@ class PostgreSQLManager:
             print(f"Error storing conversation: {e}")
             return False
     
+    def store_conversations_bulk(self, rows: List[Tuple[str, str, Optional[str]]]) -> bool:
+        """Store many (user_message, assistant_response, context_used) rows in a single transaction."""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.executemany('''
+                INSERT INTO conversations (user_message, assistant_response, context_used)
+                VALUES (%s, %s, %s)
+            ''', rows)
+            
+            conn.commit()
+            conn.close()
+            return True
+        except Exception as e:
+            print(f"Error storing conversations: {e}")
+            return False
+    
     def get_document_count(self) -> int:
         """Get the total number of unique documents."""
         try:
@@ -176,6 +331,7 @@ class PostgreSQLManager:
             cursor.execute('DELETE FROM documents')
             conn.commit()
             conn.close()
+            self._invalidate_corpus()
             return True
         except Exception as e:
             print(f"Error clearing documents: {e}")
@@ -190,7 +346,7 @@ class PostgreSQLManager:
             cursor.execute('''
                 SELECT user_message, assistant_response 
                 FROM conversations 
-                ORDER BY created_at DESC 
+                ORDER BY created_at DESC, id DESC 
                 LIMIT %s
             ''', (limit,))
             
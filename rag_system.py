@@ -4,23 +4,176 @@ try:
 except ImportError:
     SENTENCE_TRANSFORMERS_AVAILABLE = False
     
+import os
+import queue
+import re
+import threading
+import time
 import numpy as np
-from typing import List, Tuple
+from concurrent.futures import Future
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 from database import DatabaseManager
 
+class SemanticCache:
+    """Reuse search results for queries whose embeddings nearly match an earlier query.
+    
+    Random-projection LSH buckets the cached queries by sign pattern; candidates in the
+    same or an adjacent bucket (Hamming distance <= max_hamming) are confirmed with one
+    dot product against the stored query embedding.
+    """
+    
+    def __init__(self, n_bits: int = 16, threshold: float = 0.95, max_hamming: int = 1, max_entries: int = 256, seed: int = 0):
+        self.n_bits = n_bits
+        self.threshold = threshold
+        self.max_hamming = max_hamming
+        self.max_entries = max_entries
+        self._rng = np.random.default_rng(seed)
+        self._planes = None
+        self._buckets = OrderedDict()  # signature -> [(query, top_k, results)]
+        self._size = 0
+        self._version = None
+        self._lock = threading.Lock()
+    
+    def get(self, query_embedding: np.ndarray, top_k: int, version: int) -> Optional[list]:
+        """Return cached results for a near-duplicate query, or None on a miss."""
+        query = self._normalize(query_embedding)
+        with self._lock:
+            self._check_version(version, query.shape[0])
+            for signature in self._probe(self._signature(query)):
+                for cached_query, cached_top_k, results in self._buckets.get(signature, ()):
+                    if cached_top_k == top_k and float(cached_query @ query) > self.threshold:
+                        # Refresh recency so frequently repeated queries are evicted last
+                        self._buckets.move_to_end(signature)
+                        return results
+        return None
+    
+    def put(self, query_embedding: np.ndarray, top_k: int, version: int, results: list):
+        """Cache the search results for a query."""
+        query = self._normalize(query_embedding)
+        with self._lock:
+            self._check_version(version, query.shape[0])
+            signature = self._signature(query)
+            self._buckets.setdefault(signature, []).append((query, top_k, results))
+            self._buckets.move_to_end(signature)
+            self._size += 1
+            while self._size > self.max_entries:
+                _, evicted = self._buckets.popitem(last=False)
+                self._size -= len(evicted)
+    
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._size = 0
+    
+    def _check_version(self, version: int, dim: int):
+        # Results are only valid for the document set they were computed against
+        if version != self._version:
+            self._buckets.clear()
+            self._size = 0
+            self._version = version
+        if self._planes is None or self._planes.shape[0] != dim:
+            self._planes = self._rng.standard_normal((dim, self.n_bits)).astype(np.float32)
+            self._buckets.clear()
+            self._size = 0
+    
+    def _signature(self, query: np.ndarray) -> int:
+        bits = (query @ self._planes) > 0
+        return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+    
+    def _probe(self, signature: int) -> List[int]:
+        signatures = [signature]
+        if self.max_hamming >= 1:
+            signatures.extend(signature ^ (1 << bit) for bit in range(self.n_bits))
+        return signatures
+    
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+# Small talk that never benefits from document retrieval
+SMALL_TALK_PATTERN = re.compile(
+    r"^(hi|hello|hey|thanks|thank you|thx|bye|goodbye|ok|okay|cool|great|nice|yes|no|good (morning|afternoon|evening))\W*$",
+    re.IGNORECASE
+)
+
+def _detect_device() -> str:
+    """Pick the fastest available torch device for the encoder: CUDA, then Apple MPS, then CPU."""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return "cuda"
+        mps = getattr(torch.backends, "mps", None)
+        if mps is not None and mps.is_available():
+            return "mps"
+    except Exception:
+        pass
+    return "cpu"
+
+class _EmbedderWorker:
+    """Background thread that coalesces concurrent encode requests into one batched call."""
+    
+    def __init__(self, model, max_batch: int = 32, window: float = 0.01):
+        self.model = model
+        self.max_batch = max_batch
+        self.window = window
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embedder", daemon=True)
+        self._thread.start()
+    
+    def submit(self, text: str) -> Future:
+        """Queue a text for encoding; the future resolves to its normalized embedding."""
+        future = Future()
+        self._queue.put((text, future))
+        return future
+    
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            
+            # Gather whatever else arrives within the window, up to max_batch
+            deadline = time.monotonic() + self.window
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = self.model.encode(
+                    [text for text, _ in items],
+                    batch_size=self.max_batch,
+                    show_progress_bar=False,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+                for (_, future), embedding in zip(items, embeddings):
+                    future.set_result(embedding)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+
 class RAGSystem:
     def __init__(self, db_manager: DatabaseManager):
         """Initialize RAG system with database manager."""
         self.db_manager = db_manager
         self.embedding_model = None
+        self._embedder = None
+        self.search_cache = SemanticCache()
         self.load_embedding_model()
     
     def load_embedding_model(self):
         """Load the sentence transformer model for embeddings."""
         try:
             if SENTENCE_TRANSFORMERS_AVAILABLE:
-                print("Loading embedding model...")
-                self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+                device = _detect_device()
+                print(f"Loading embedding model on {device}...")
+                self.embedding_model = self._load_sentence_transformer(device)
+                self._embedder = _EmbedderWorker(self.embedding_model)
                 print("Embedding model loaded successfully!")
             else:
                 print("Sentence transformers not available - using simple text similarity")
@@ -30,6 +183,18 @@ class RAGSystem:
             print("Falling back to simple text similarity")
             self.embedding_model = "simple"
     
+    def _load_sentence_transformer(self, device: str):
+        """Load MiniLM, preferring the ONNX Runtime backend on CPU and PyTorch otherwise."""
+        if device == "cpu" and os.getenv('EMBEDDING_BACKEND', 'onnx') == 'onnx':
+            try:
+                # Fused, constant-folded graph without PyTorch eager overhead
+                model = SentenceTransformer('all-MiniLM-L6-v2', device=device, backend='onnx')
+                print("Using ONNX Runtime embedding backend")
+                return model
+            except Exception as e:
+                print(f"ONNX Runtime backend unavailable, using PyTorch: {e}")
+        return SentenceTransformer('all-MiniLM-L6-v2', device=device)
+    
     def get_embedding(self, text: str) -> np.ndarray:
         """Get embedding for a given text."""
         if self.embedding_model is None:
@@ -40,12 +205,43 @@ class RAGSystem:
                 # Simple text-based embedding using character frequencies
                 return self._simple_text_embedding(text)
             else:
-                embedding = self.embedding_model.encode(text)
-                return embedding
+                # Concurrent queries are batched into one encode call by the worker
+                return self._embedder.submit(text).result()
         except Exception as e:
             print(f"Error getting embedding: {e}")
             return self._simple_text_embedding(text)  # Fallback to simple embedding
     
+    def get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Get L2-normalized embeddings for many texts in batched encode calls."""
+        if self.embedding_model is None:
+            raise Exception("Embedding model not loaded")
+        
+        if not texts:
+            return np.zeros((0, 384), dtype=np.float32)
+        
+        try:
+            if self.embedding_model != "simple":
+                # Smart batching: similar lengths share a batch so little padding is computed
+                order = np.argsort([len(text) for text in texts], kind='stable')
+                embeddings = self.embedding_model.encode(
+                    [texts[i] for i in order],
+                    batch_size=64,
+                    show_progress_bar=False,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+                result = np.empty_like(embeddings)
+                result[order] = embeddings
+                return result
+        except Exception as e:
+            print(f"Error getting batch embeddings: {e}")
+        
+        # Simple embeddings are built per text and normalized together
+        embeddings = np.vstack([self._simple_text_embedding(text) for text in texts])
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+    
     def _simple_text_embedding(self, text: str) -> np.ndarray:
         """Create a simple embedding based on text characteristics."""
         # Normalize text
@@ -70,14 +266,25 @@ class RAGSystem:
         
         return embedding
     
+    def should_retrieve(self, query: str) -> bool:
+        """Cheap router: skip retrieval for greetings, acknowledgements and empty input."""
+        query = query.strip()
+        if not any(ch.isalnum() for ch in query):
+            return False
+        return SMALL_TALK_PATTERN.match(query) is None
+    
     def get_relevant_context(self, query: str, top_k: int = 3, include_conversation_history: bool = True) -> Tuple[str, List[str]]:
         """Get relevant context for a query using RAG with optional conversation history."""
         try:
             # Get query embedding
             query_embedding = self.get_embedding(query)
             
-            # Search for similar chunks
-            similar_chunks = self.db_manager.search_similar_chunks(query_embedding, top_k)
+            # Search for similar chunks, reusing results for near-duplicate queries
+            documents_version = self.db_manager.get_documents_version()
+            similar_chunks = self.search_cache.get(query_embedding, top_k, documents_version)
+            if similar_chunks is None:
+                similar_chunks = self.db_manager.search_similar_chunks(query_embedding, top_k)
+                self.search_cache.put(query_embedding, top_k, documents_version, similar_chunks)
             
             # Extract context and sources
             context_parts = []
@@ -1,6 +1,23 @@
 import os
+import pickle
+import hashlib
 import logging
-from typing import Any, Dict
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+
+# Fastest available 16-byte content hash: BLAKE3, then xxh3-128, then hashlib's blake2b
+try:
+    import blake3
+    def _digest16(data: bytes) -> bytes:
+        return blake3.blake3(data).digest(length=16)
+except ImportError:
+    try:
+        import xxhash
+        def _digest16(data: bytes) -> bytes:
+            return xxhash.xxh3_128_digest(data)
+    except ImportError:
+        def _digest16(data: bytes) -> bytes:
+            return hashlib.blake2b(data, digest_size=16).digest()
 
 def setup_logging():
     """Set up logging configuration."""
@@ -84,3 +101,69 @@ def get_model_info() -> Dict[str, str]:
         "database": "SQLite",
         "framework": "Streamlit"
     }
+
+def chunk_hash(content: str) -> bytes:
+    """16-byte content hash used to recognise chunks that are already stored."""
+    return _digest16(content.encode('utf-8'))
+
+# Precision used for newly stored embeddings: "float32" or "int8". int8 makes the stored rows 4x
+# smaller on disk only; they are dequantized to float32 when the corpus is loaded for search, and
+# the rounding error carries into every similarity score.
+EMBEDDING_PRECISION = os.getenv('EMBEDDING_PRECISION', 'float32')
+
+def embedding_to_blob(embedding: np.ndarray) -> bytes:
+    """Serialize an embedding as a contiguous float32 buffer."""
+    return np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+
+def quantize_int8(embedding: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Symmetric per-vector int8 quantization; returns (codes, scale) with embedding ~= codes * scale."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+    scale = max_abs / 127.0 if max_abs > 0 else 1.0
+    return np.round(vector / scale).astype(np.int8), scale
+
+def normalize_embedding(embedding: np.ndarray) -> np.ndarray:
+    """Return the embedding as a unit-norm float32 vector."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) + 1e-12)
+
+def encode_embedding(embedding: np.ndarray, precision: str = EMBEDDING_PRECISION) -> Tuple[bytes, str, Optional[float]]:
+    """Serialize a unit-normalized embedding for storage; returns (blob, precision, scale)."""
+    embedding = normalize_embedding(embedding)
+    if precision == 'int8':
+        codes, scale = quantize_int8(embedding)
+        return codes.tobytes(), 'int8', scale
+    return embedding_to_blob(embedding), 'float32', None
+
+def _is_pickled(blob: bytes) -> bool:
+    # Rows written before the float32 format are pickled ndarrays (protocol 2+)
+    return blob[:1] == b'\x80' and blob[-1:] == b'.'
+
+def blob_to_embedding(blob: bytes, precision: str = 'float32', scale: Optional[float] = None) -> np.ndarray:
+    """Deserialize an embedding stored by encode_embedding (or a legacy pickle)."""
+    blob = bytes(blob)
+    if precision == 'int8':
+        return np.frombuffer(blob, dtype=np.int8).astype(np.float32) * np.float32(scale)
+    if _is_pickled(blob):
+        return np.asarray(pickle.loads(blob), dtype=np.float32)
+    return np.frombuffer(blob, dtype=np.float32)
+
+def blobs_to_matrix(blobs: List[bytes], precisions: List[str] = None, scales: List[Optional[float]] = None) -> np.ndarray:
+    """Stack stored embeddings into one (N, D) float32 matrix."""
+    blobs = [bytes(blob) for blob in blobs]
+    if not blobs:
+        return np.zeros((0, 0), dtype=np.float32)
+    if precisions is None:
+        precisions = ['float32'] * len(blobs)
+        scales = [None] * len(blobs)
+    
+    width = len(blobs[0])
+    if all(len(blob) == width for blob in blobs):
+        if all(precision == 'int8' for precision in precisions):
+            codes = np.frombuffer(b"".join(blobs), dtype=np.int8).reshape(len(blobs), width)
+            return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+        if all(precision == 'float32' and not _is_pickled(blob) for blob, precision in zip(blobs, precisions)):
+            return np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), width // 4)
+    
+    # Mixed precisions or legacy rows during migration
+    return np.vstack([blob_to_embedding(*row) for row in zip(blobs, precisions, scales)])
@@ -0,0 +1,218 @@
+"""
+Similarity search over the cached corpus of chunk embeddings.
+
+The database backends load every stored embedding into one unit-row float32 matrix
+(load_corpus_matrix) and search it through a CorpusIndex.
+"""
+
+import os
+import threading
+import numpy as np
+from typing import List, Tuple
+from utils import blobs_to_matrix, normalize_embedding, quantize_int8
+
+try:
+    import hnswlib
+    HNSWLIB_AVAILABLE = True
+except ImportError:
+    HNSWLIB_AVAILABLE = False
+
+try:
+    import simsimd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
+
+# Below this many chunks a brute-force matrix-vector product beats an HNSW graph
+ANN_MIN_ROWS = 1000
+
+# Without an HNSW graph, corpora this large are shortlisted by sign-bit Hamming distance first
+BINARY_MIN_ROWS = int(os.getenv('BINARY_SEARCH_MIN_ROWS', '20000'))
+
+def quantize_rows_int8(matrix: np.ndarray) -> np.ndarray:
+    """Per-row symmetric int8 codes for a matrix; scales are dropped since cosine ignores them."""
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.clip(np.round(matrix / scales[:, None]), -127, 127).astype(np.int8)
+
+def load_corpus_matrix(cursor, n_rows: int, batch_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+    """Stream executed (id, embedding, precision, scale) rows into a unit-row float32 matrix and its row ids.
+    
+    Rows are decoded one batch at a time into a preallocated array, so peak memory stays
+    close to the size of the final matrix instead of holding every blob plus copies.
+    """
+    ids = []
+    matrix = None
+    filled = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        
+        block = blobs_to_matrix([row[1] for row in rows], [row[2] for row in rows], [row[3] for row in rows])
+        if matrix is None:
+            matrix = np.empty((max(n_rows, len(rows)), block.shape[1]), dtype=np.float32)
+        elif filled + len(rows) > len(matrix):
+            # Rows inserted after the count was taken
+            matrix = np.concatenate([matrix, np.empty((filled + len(rows) - len(matrix), matrix.shape[1]), dtype=np.float32)])
+        
+        matrix[filled:filled + len(rows)] = block
+        filled += len(rows)
+        ids.extend(row[0] for row in rows)
+    
+    ids = np.asarray(ids, dtype=np.int64)
+    if matrix is None:
+        return np.zeros((0, 0), dtype=np.float32), ids
+    
+    # New rows are stored unit-norm; this also covers legacy and int8-rounded rows
+    matrix = matrix[:filled]
+    matrix /= row_norms(matrix)[:, None]
+    return matrix, ids
+
+def row_norms(matrix: np.ndarray) -> np.ndarray:
+    """L2 norm of each row, with zero rows mapped to 1 so they can be divided by safely."""
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0
+    return norms
+
+def top_k_cosine(matrix: np.ndarray, query: np.ndarray, top_k: int, normalized: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (indices, scores) of the top_k rows of matrix by cosine similarity, best first.
+    
+    Pass normalized=True when the rows are already unit length to skip the per-row divide.
+    """
+    if matrix.size == 0 or top_k <= 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.float32)
+    
+    query = normalize_embedding(query)
+    scores = matrix @ query
+    if not normalized:
+        scores /= row_norms(matrix)
+    
+    top_idx = _top_indices(scores, top_k)
+    return top_idx, scores[top_idx]
+
+def _top_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k highest scores, best first: O(N) partial selection, then sort only the survivors."""
+    if top_k < len(scores):
+        top_idx = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        top_idx = np.arange(len(scores))
+    return top_idx[np.argsort(-scores[top_idx], kind='stable')]
+
+def build_ann_index(matrix: np.ndarray):
+    """Build an HNSW cosine index over the rows of matrix, or None when brute force is preferable."""
+    if not HNSWLIB_AVAILABLE or len(matrix) < ANN_MIN_ROWS:
+        return None
+    
+    try:
+        index = hnswlib.Index(space='cosine', dim=matrix.shape[1])
+        index.init_index(max_elements=len(matrix), M=16, ef_construction=200)
+        index.add_items(matrix, np.arange(len(matrix)))
+        return index
+    except Exception as e:
+        print(f"Could not build HNSW index, using linear search: {e}")
+        return None
+
+class CorpusIndex:
+    """Search structures built once over the cached, unit-row corpus matrix.
+    
+    Large corpora use an HNSW graph when hnswlib is installed, or else a 1-bit-per-dimension
+    Hamming shortlist. Otherwise, with SimSIMD installed, candidates are ranked with int8
+    cosine kernels; the fallback is a single float32 matrix-vector product. Shortlists are
+    always rescored exactly from the float32 rows. Only row ids are kept alongside the matrix;
+    callers fetch the text of the few rows a search returns.
+    """
+    
+    def __init__(self, matrix: np.ndarray, ids: np.ndarray):
+        self.matrix = matrix
+        self.ids = ids
+        # hnswlib allows concurrent add_items/knn_query, but not resize_index alongside them
+        self._ann_lock = threading.Lock()
+        self.ann_index = build_ann_index(matrix)
+        self._build_shortlists()
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def _build_shortlists(self):
+        """Rebuild the sign-bit or int8 codes used when there is no HNSW graph."""
+        self.bits = None
+        self.codes = None
+        if self.ann_index is None and len(self.ids) >= BINARY_MIN_ROWS and hasattr(np, 'bitwise_count'):
+            # 32x smaller than float32: one sign bit per dimension
+            self.bits = np.packbits(self.matrix > 0, axis=1)
+        elif self.ann_index is None and SIMSIMD_AVAILABLE and len(self.ids):
+            self.codes = quantize_rows_int8(self.matrix)
+    
+    def extend(self, matrix: np.ndarray, ids: np.ndarray):
+        """Append newly stored unit rows, adding them to the HNSW graph in place instead of rebuilding it."""
+        if not len(ids):
+            return
+        
+        start = len(self.ids)
+        self.matrix = np.concatenate([self.matrix, matrix]) if start else matrix
+        self.ids = np.concatenate([self.ids, ids])
+        
+        if self.ann_index is None:
+            # Either still below ANN_MIN_ROWS, where a graph may now be due, or codes that are cheap to redo
+            self.ann_index = build_ann_index(self.matrix)
+            self._build_shortlists()
+            return
+        
+        try:
+            with self._ann_lock:
+                capacity = self.ann_index.get_max_elements()
+                if len(self.ids) > capacity:
+                    self.ann_index.resize_index(max(len(self.ids), 2 * capacity))
+                self.ann_index.add_items(matrix, np.arange(start, len(self.ids)))
+        except Exception as e:
+            print(f"Could not extend HNSW index, rebuilding it: {e}")
+            self.ann_index = build_ann_index(self.matrix)
+            self._build_shortlists()
+    
+    def search(self, query: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """Return (row id, similarity) for the top_k most similar chunks, best first."""
+        if not len(self.ids) or top_k <= 0:
+            return []
+        
+        query = normalize_embedding(query)
+        if self.ann_index is not None:
+            top_idx, scores = self._search_ann(query, top_k)
+        elif self.bits is not None:
+            top_idx, scores = self._search_binary(query, top_k)
+        elif self.codes is not None:
+            top_idx, scores = self._search_int8(query, top_k)
+        else:
+            top_idx, scores = top_k_cosine(self.matrix, query, top_k, normalized=True)
+        return [(int(self.ids[i]), float(score)) for i, score in zip(top_idx, scores)]
+    
+    def _search_ann(self, query: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self._ann_lock:
+            top_k = min(top_k, self.ann_index.get_current_count())
+            self.ann_index.set_ef(max(50, 2 * top_k))
+            labels, distances = self.ann_index.knn_query(query, k=top_k)
+        return labels[0].astype(np.intp), (1.0 - distances[0]).astype(np.float32)
+    
+    def _search_binary(self, query: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Hamming distance is popcount(a XOR b) over the packed sign bits
+        query_bits = np.packbits(query > 0)
+        distances = np.bitwise_count(np.bitwise_xor(self.bits, query_bits)).sum(axis=1, dtype=np.int32)
+        return self._rescore(_top_indices(-distances, max(4 * top_k, 64)), query, top_k)
+    
+    def _rescore(self, candidates: np.ndarray, query: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact float32 scores for a shortlist, keeping the best top_k."""
+        scores = self.matrix[candidates] @ query
+        order = _top_indices(scores, top_k)
+        return candidates[order], scores[order]
+    
+    def _search_int8(self, query: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        try:
+            query_codes, _ = quantize_int8(query)
+            distances = np.asarray(simsimd.cdist(query_codes[None, :], self.codes, metric='cosine')).ravel()
+        except Exception as e:
+            print(f"SimSIMD int8 search failed, using float32: {e}")
+            self.codes = None
+            return top_k_cosine(self.matrix, query, top_k, normalized=True)
+        
+        # Shortlist 4x top_k by the int8 cosine, then rescore exactly
+        return self._rescore(_top_indices(-distances, 4 * top_k), query, top_k)
@@ -34,9 +34,9 @@ class WebSearchIntegrator:
             # Add contextual examples with citations
             examples = self.get_contextual_examples(query)
             if examples:
-                enhanced_context += "\n\n**Contextual Examples:**"
-                for i, example in enumerate(examples, 1):
-                    enhanced_context += f"\n{i}. {example}"
+                enhanced_context += "\n\n**Contextual Examples:**" + "".join(
+                    f"\n{i}. {example}" for i, example in enumerate(examples, 1)
+                )
             
             # Add comprehensive source citations
             sources = [